@@ -17,6 +17,7 @@ setup(name='TracGit',
       See http://trac-hacks.org/wiki/GitPlugin for more details.
       """,
       packages=['tracext', 'tracext.git'],
+      test_suite='tracext.git.tests.suite',
       namespace_packages=['tracext'],
       entry_points = {'trac.plugins': 'git = tracext.git.git_fs'},
       package_data={'': ['COPYING','README']}
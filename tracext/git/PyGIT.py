@@ -8,17 +8,27 @@ from __future__ import with_statement
 
 from future27 import namedtuple
 
-import os, re, sys, time, weakref
+import os, re, sys, time, weakref, zlib
+import marshal
+from array import array
+from itertools import izip
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
 from collections import deque
+from datetime import datetime, timedelta, tzinfo
 from functools import partial
-from threading import Lock
+from threading import Lock, Thread, Timer, local
+from thread import get_ident
+from types import GeneratorType, MethodType
 from subprocess import Popen, PIPE
 from operator import itemgetter
 from contextlib import contextmanager
+from Queue import Queue, Full
 import cStringIO
 import codecs
 
-__all__ = ["git_version", "GitError", "GitErrorSha", "Storage", "StorageFactory"]
+__all__ = ["git_version", "GitError", "GitErrorSha", "GitTimeout", "Storage", "StorageFactory",
+           "GitCommandStats", "command_stats", "StorageTracer", "Commit"]
 
 class GitError(Exception):
     pass
@@ -26,14 +36,267 @@ class GitError(Exception):
 class GitErrorSha(GitError):
     pass
 
+class GitTimeout(GitError):
+    pass
+
+class GitCommandStats(object):
+    """
+    Thread-safe accounting of git command invocations
+
+    Keeps process-wide totals per git sub-command as well as a
+    per-thread breakdown between `begin_scope()` and `end_scope()`
+    (e.g. for the request currently served by that thread)
+    """
+
+    CommandStats = namedtuple('CommandStats', 'count time bytes errors')
+
+    def __init__(self):
+        # commands taking at least that many seconds are logged as warnings
+        self.slow_threshold = None
+
+        self.__totals = {}
+        self.__lock = Lock()
+        self.__local = local()
+
+    @staticmethod
+    def __add(d, cmd, sample):
+        old = d.get(cmd)
+        if old is not None:
+            sample = GitCommandStats.CommandStats(*[ a + b for a, b in zip(old, sample) ])
+        d[cmd] = sample
+
+    def record(self, cmd, elapsed, nbytes, returncode=0):
+        """
+        account for one invocation of `cmd` which took `elapsed` seconds
+        and produced `nbytes` bytes of output; a `returncode` other than
+        0 or `None` is counted as error
+        """
+
+        sample = GitCommandStats.CommandStats(1, elapsed, nbytes,
+                                              int(returncode not in (0, None)))
+
+        with self.__lock:
+            self.__add(self.__totals, cmd, sample)
+
+        scope = getattr(self.__local, 'scope', None)
+        if scope is not None:
+            self.__add(scope, cmd, sample)
+
+    def get_stats(self):
+        "returns dict mapping git sub-commands to CommandStats tuples"
+        with self.__lock:
+            return dict(self.__totals)
+
+    def reset(self):
+        with self.__lock:
+            self.__totals.clear()
+
+    def begin_scope(self):
+        "start collecting a per-thread breakdown"
+        self.__local.scope = {}
+
+    def end_scope(self):
+        "stop collecting per-thread breakdown and return it"
+        scope = getattr(self.__local, 'scope', None)
+        self.__local.scope = None
+        return scope or {}
+
+    @staticmethod
+    def format_stats(stats):
+        "render dict returned by get_stats() or end_scope() as single line"
+        return ", ".join("%s: %d calls, %.1f ms, %d bytes, %d errors"
+                         % (cmd, s.count, 1000*s.time, s.bytes, s.errors)
+                         for cmd, s in sorted(stats.iteritems()))
+
+# process-wide default instance used by GitCore
+command_stats = GitCommandStats()
+
+class StorageTracer(object):
+    """
+    Records calls of the public Storage API as lines of JSON objects
+
+    Each line describes one call with the keys `ts` (start time),
+    `thread`, `repo` (git dir), `method`, `args`, `kw`, `elapsed`
+    (seconds) and `error` (exception class name or null).  Calls
+    returning generators are timed until the generator is exhausted
+    or closed; for `get_historian` the paths looked up within the
+    context are recorded as `paths` keyword.  Iterators passed as
+    arguments are turned into lists (and recorded as such).
+
+    All public methods of Storage are traced (see `traced_methods()`),
+    but only the outermost call of nested ones.
+
+    Traces can be replayed with `python -m tracext.git.replay`.
+    """
+
+    # housekeeping methods called by StorageFactory rather than on behalf of requests
+    UNTRACED_METHODS = ('close_idle_pipe', 'get_memory_usage')
+
+    __instances = {}
+    __instances_lock = Lock()
+
+    @classmethod
+    def get(cls, path):
+        "returns the process-wide tracer appending to the file `path`"
+
+        with cls.__instances_lock:
+            try:
+                return cls.__instances[path]
+            except KeyError:
+                tracer = cls.__instances[path] = cls(path)
+                return tracer
+
+    def __init__(self, path):
+        try:
+            import json
+        except ImportError: # Python 2.5
+            import simplejson as json
+
+        self.__dumps = json.dumps
+        self.__f = open(path, 'a')
+        self.__lock = Lock()
+        self.__local = local() # nesting depth of traced calls per thread
+
+    @staticmethod
+    def __to_json(o):
+        if isinstance(o, (set, frozenset)):
+            return sorted(o)
+        return None # e.g. historian functions
+
+    def record(self, repo, method, args, kw, ts0, elapsed, error=None):
+        line = self.__dumps(dict(ts=ts0, thread=get_ident(), repo=repo, method=method,
+                                 args=args, kw=kw, elapsed=elapsed,
+                                 error=error and error.__class__.__name__),
+                            default=self.__to_json)
+
+        with self.__lock:
+            self.__f.write(line + '\n')
+            self.__f.flush()
+
+    @classmethod
+    def traced_methods(cls, storage_class):
+        "returns names of the public (instance) methods of `storage_class` to be traced"
+
+        names = []
+        for name in dir(storage_class):
+            if name.startswith('_') or name in cls.UNTRACED_METHODS:
+                continue
+            attr = getattr(storage_class, name)
+            # skips properties, static and class methods
+            if isinstance(attr, MethodType) and attr.im_self is None:
+                names.append(name)
+        return names
+
+    def instrument(self, storage, git_dir):
+        """
+        shadow the traced methods of `storage` by tracing wrappers
+
+        the wrappers only hold a weak reference to `storage`, so that
+        no reference cycles are created
+        """
+
+        storage_ref = weakref.ref(storage)
+        for name in self.traced_methods(type(storage)):
+            func = getattr(type(storage), name)
+            if name == 'get_historian':
+                wrapper = self.__wrap_historian(git_dir, func, storage_ref)
+            else:
+                wrapper = self.__wrap(git_dir, name, func, storage_ref)
+            setattr(storage, name, wrapper)
+
+    def __wrap(self, git_dir, name, func, storage_ref):
+        record = self.record
+        local = self.__local
+
+        def traced_gen(gen, args, kw, ts0):
+            error = None
+            try:
+                while True:
+                    local.depth = getattr(local, 'depth', 0) + 1
+                    try:
+                        item = gen.next()
+                    except StopIteration:
+                        break
+                    except Exception, e:
+                        error = e
+                        raise
+                    finally:
+                        local.depth -= 1
+                    yield item
+            finally:
+                gen.close()
+                record(git_dir, name, args, kw, ts0, time.time() - ts0, error)
+
+        def traced(*args, **kw):
+            depth = getattr(local, 'depth', 0)
+            if depth: # only calls from outside Storage are recorded
+                return func(storage_ref(), *args, **kw)
+
+            # record what's actually passed instead of consumed iterators
+            args = tuple(hasattr(a, 'next') and list(a) or a for a in args)
+
+            ts0 = time.time()
+            local.depth = depth + 1
+            try:
+                result = func(storage_ref(), *args, **kw)
+            except Exception, e:
+                local.depth = depth
+                record(git_dir, name, args, kw, ts0, time.time() - ts0, e)
+                raise
+            local.depth = depth
+
+            if isinstance(result, GeneratorType):
+                return traced_gen(result, args, kw, ts0)
+
+            record(git_dir, name, args, kw, ts0, time.time() - ts0)
+            return result
+
+        return traced
+
+    def __wrap_historian(self, git_dir, func, storage_ref):
+        record = self.record
+        local = self.__local
+
+        def traced(sha, base_path):
+            if getattr(local, 'depth', 0): # only calls from outside Storage are recorded
+                return func(storage_ref(), sha, base_path)
+            return outermost(sha, base_path)
+
+        @contextmanager
+        def outermost(sha, base_path):
+            ts0 = time.time()
+            paths = []
+            error = None
+            try:
+                try:
+                    with func(storage_ref(), sha, base_path) as historian:
+                        def traced_historian(path):
+                            paths.append(path)
+                            local.depth = getattr(local, 'depth', 0) + 1
+                            try:
+                                return historian(path)
+                            finally:
+                                local.depth -= 1
+                        yield traced_historian
+                except Exception, e:
+                    error = e
+                    raise
+            finally:
+                record(git_dir, 'get_historian', (sha, base_path), dict(paths=paths),
+                       ts0, time.time() - ts0, error)
+
+        return traced
+
 class GitCore(object):
     """
     Low-level wrapper around git executable
     """
 
-    def __init__(self, git_dir=None, git_bin="git"):
+    def __init__(self, git_dir=None, git_bin="git", log=None, stats=None):
         self.__git_bin = git_bin
         self.__git_dir = git_dir
+        self.__log = log
+        self.__stats = stats or command_stats
 
     def __repr__(self):
         return '<GitCore bin="%s" dir="%s">' % (self.__git_bin, self.__git_dir)
@@ -56,26 +319,86 @@ class GitCore(object):
             return Popen(self.__build_git_cmd(git_cmd, *cmd_args),
                          close_fds=True, **kw)
 
-    def __execute(self, git_cmd, *cmd_args):
-        "execute git command and return file-like object of stdout"
+    def __execute(self, git_cmd, *cmd_args, **kw):
+        """
+        execute git command and return file-like object of stdout
+
+        the keyword argument `input` may provide data to be fed to stdin;
+        if `timeout` (seconds) is given, the command is terminated when
+        exceeding it and GitTimeout is raised; if `with_stderr` is set,
+        a (stdout, stderr) tuple is returned
+        """
 
         #print >>sys.stderr, "DEBUG:", git_cmd, cmd_args
 
-        p = self.__pipe(git_cmd, *cmd_args, stdout=PIPE, stderr=PIPE)
+        input = kw.get('input')
+        timeout = kw.get('timeout')
 
-        stdout_data, stderr_data = p.communicate()
+        ts0 = time.time()
+        p = self.__pipe(git_cmd, *cmd_args, stdout=PIPE, stderr=PIPE,
+                        stdin=input is not None and PIPE or None)
+
+        timer = None
+        timed_out = []
+        if timeout:
+            def terminate():
+                timed_out.append(True)
+                p.terminate()
+            timer = Timer(timeout, terminate)
+            timer.start()
+
+        try:
+            stdout_data, stderr_data = p.communicate(input)
+        finally:
+            if timer is not None:
+                timer.cancel()
         #TODO, do something with p.returncode, e.g. raise exception
 
+        self.record(git_cmd, time.time() - ts0, len(stdout_data), p.returncode, cmd_args)
+
+        if timed_out:
+            raise GitTimeout("git %s exceeded %s s" % (git_cmd, timeout))
+
+        if kw.get('with_stderr'):
+            return stdout_data, stderr_data
+
         return stdout_data
 
+    def record(self, git_cmd, elapsed, nbytes, returncode=0, cmd_args=()):
+        "account for a git invocation (also used for long-running pipes)"
+
+        self.__stats.record(git_cmd, elapsed, nbytes, returncode)
+
+        if self.__log is None:
+            return
+
+        threshold = self.__stats.slow_threshold
+        if threshold is not None and elapsed >= threshold:
+            self.__log.warning("slow git command (took %.1f ms, %d bytes, exit status %s): %s"
+                               % (1000*elapsed, nbytes, returncode,
+                                  " ".join((git_cmd,) + tuple(cmd_args))))
+        elif returncode not in (0, None):
+            self.__log.debug("git command exited with status %s: %s"
+                             % (returncode, " ".join((git_cmd,) + tuple(cmd_args))))
+
     def cat_file_batch(self):
         return self.__pipe('cat-file', '--batch', stdin=PIPE, stdout=PIPE)
 
-    def log_pipe(self, *cmd_args):
-        return self.__pipe('log', *cmd_args, stdout=PIPE)
+    def log_pipe(self, *cmd_args, **kw):
+        return self.__pipe('log', *cmd_args, stdout=PIPE, **kw)
+
+    def diff_tree_pipe(self, *cmd_args):
+        return self.__pipe('diff-tree', *cmd_args, stdin=PIPE, stdout=PIPE)
+
+    def archive_pipe(self, *cmd_args):
+        return self.__pipe('archive', *cmd_args, stdout=PIPE)
+
+    def cat_file_pipe(self, *cmd_args):
+        return self.__pipe('cat-file', *cmd_args, stdout=PIPE)
 
     def __getattr__(self, name):
-        if name[0] == '_' or name in ['cat_file_batch', 'log_pipe']:
+        if name[0] == '_' or name in ['cat_file_batch', 'log_pipe', 'diff_tree_pipe',
+                                      'archive_pipe', 'cat_file_pipe']:
             raise AttributeError, name
         return partial(self.__execute, name.replace('_','-'))
 
@@ -94,6 +417,182 @@ class GitCore(object):
 
         return bool(cls.__is_sha_pat.match(sha))
 
+class _StallWatchdog(Thread):
+    """
+    Terminates process `p` if reading its output (between `arm()` and
+    `disarm()` calls) stalls for more than `timeout` seconds, in which
+    case `fired` gets set
+    """
+
+    def __init__(self, p, timeout):
+        Thread.__init__(self, name="PyGIT watchdog")
+        self.setDaemon(True)
+        self.p = p
+        self.timeout = timeout
+        self.fired = False
+        self.__armed = None # time reading started
+        self.__stopped = []
+        self.start()
+
+    def arm(self):
+        self.__armed = time.time()
+
+    def disarm(self):
+        self.__armed = None
+
+    def stop(self):
+        self.__stopped.append(True)
+
+    def run(self):
+        interval = min(1.0, self.timeout / 4.0)
+        while not self.__stopped and self.p.poll() is None:
+            armed = self.__armed
+            if armed is not None and time.time() - armed > self.timeout:
+                self.fired = True
+                self.p.terminate()
+                return
+            time.sleep(interval)
+
+class GitTimezone(tzinfo):
+    """
+    Fixed offset timezone as found in git's author/committer lines
+
+    use get_timezone() for obtaining (shared) instances
+    """
+
+    def __init__(self, tz_str):
+        sign = tz_str.startswith('-') and -1 or 1
+        minutes = int(tz_str[-4:-2]) * 60 + int(tz_str[-2:])
+        self.__offset = timedelta(minutes=sign*minutes)
+        self.__name = tz_str
+
+    def __repr__(self):
+        return '<GitTimezone %s>' % self.__name
+
+    def utcoffset(self, dt):
+        return self.__offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return self.__name
+
+__timezones = {}
+
+def get_timezone(tz_str):
+    "returns interned GitTimezone instance for '+hhmm'-style timezone string"
+    try:
+        return __timezones[tz_str]
+    except KeyError:
+        return __timezones.setdefault(tz_str, GitTimezone(tz_str))
+
+def parse_user_time(s):
+    """
+    parse author/committer attribute lines and return
+    (user,timestamp)
+    """
+
+    user, time, tz_str = s.rsplit(None, 2)
+    return user, datetime.fromtimestamp(float(time), get_timezone(tz_str))
+
+class Commit(object):
+    """
+    Parsed commit object
+
+    Commit records are cached and shared, and therefore immutable.
+    `headers` holds all (key, value) header lines in their original
+    order, with continuation lines (as in 'gpgsig') joined by newlines.
+    """
+
+    __slots__ = ('sha', 'tree', 'parents', 'author', 'author_time',
+                 'committer', 'committer_time', 'message', 'headers')
+
+    def __init__(self, sha, tree, parents, author, author_time,
+                 committer, committer_time, message, headers):
+        for name, value in zip(Commit.__slots__, (sha, tree, parents, author, author_time,
+                                                   committer, committer_time, message, headers)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Commit records are immutable")
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        return '<Commit %s>' % self.sha
+
+    @classmethod
+    def parse(cls, sha, raw):
+        "create Commit record from (decoded) raw commit object"
+
+        lines = raw.splitlines()
+
+        if not lines:
+            raise GitErrorSha
+
+        headers = []
+        for i, line in enumerate(lines):
+            if not line:
+                break
+            if line.startswith(' ') and headers: # continuation line
+                key, value = headers[-1]
+                headers[-1] = key, value + '\n' + line[1:]
+            else:
+                key, _, value = line.partition(' ')
+                headers.append((key, value.strip()))
+        else:
+            i = len(lines) # no message at all
+
+        tree = None
+        parents = []
+        author = author_time = committer = committer_time = None
+
+        for key, value in headers:
+            if key == 'tree':
+                tree = str(value)
+            elif key == 'parent':
+                parents.append(str(value))
+            elif key == 'author' and author is None:
+                author, author_time = parse_user_time(value)
+            elif key == 'committer' and committer is None:
+                committer, committer_time = parse_user_time(value)
+
+        return cls(sha, tree, tuple(parents), author, author_time,
+                   committer, committer_time, "\n".join(lines[i+1:]), tuple(headers))
+
+# sys.getsizeof() is only available with Python >= 2.6; fall back to
+# a crude guess based on the number of items otherwise
+_getsizeof = getattr(sys, 'getsizeof', lambda o: 32 + 8 * len(o) if hasattr(o, '__len__') else 16)
+
+def _deep_sizeof(obj, seen):
+    """
+    estimate memory footprint of `obj` including the objects it
+    refers to (traversing dicts, lists, tuples, sets, deques and
+    Commit records);
+    objects whose id() is already in `seen` are not accounted again
+    """
+
+    size = 0
+    todo = [obj]
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        size += _getsizeof(o)
+
+        if isinstance(o, dict):
+            todo.extend(o.iterkeys())
+            todo.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            todo.extend(o)
+        elif isinstance(o, Commit):
+            todo.extend(getattr(o, name) for name in Commit.__slots__)
+
+    return size
+
 class SizedDict(dict):
     """
     Size-bounded dictionary with FIFO replacement strategy
@@ -124,35 +623,243 @@ class SizedDict(dict):
     def setdefault(self, *_):
         raise NotImplemented("SizedDict has no setdefault() method")
 
+class LRUDict(dict):
+    """
+    Size-bounded dictionary with least-recently-used replacement strategy
+
+    Both reading and writing an entry count as use.  The order of use is
+    kept in a circular doubly linked list (of [prev, next, key] links),
+    so that both updating it and evicting the least recently used
+    entries take constant time.
+    """
+
+    def __init__(self, max_size=0):
+        dict.__init__(self)
+        self.__max_size = max_size
+        self.__root = root = [] # sentinel; root[1] is the least recently used link
+        root[:] = [root, root, None]
+        self.__links = {} # key -> link
+        self.__lock = Lock()
+
+    def __touch(self, name):
+        "moves `name` to the most recently used end of the list (lock must be held)"
+
+        link = self.__links.get(name)
+        if link is None:
+            link = self.__links[name] = [None, None, name]
+        else:
+            prev, next, _ = link
+            prev[1] = next
+            next[0] = prev
+
+        root = self.__root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def __getitem__(self, name):
+        with self.__lock:
+            value = dict.__getitem__(self, name)
+            self.__touch(name)
+            return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name, value):
+        with self.__lock:
+            dict.__setitem__(self, name, value)
+            self.__touch(name)
+
+            root = self.__root
+            while len(self) > self.__max_size:
+                link = root[1]
+                root[1] = link[1]
+                link[1][0] = root
+                del self.__links[link[2]]
+                dict.__delitem__(self, link[2])
+
+    def setdefault(self, *_):
+        raise NotImplemented("LRUDict has no setdefault() method")
+
 class StorageFactory(object):
+    """
+    Hands out a shared Storage instance per repository
+
+    Repository paths are canonicalized, so that aliases share one
+    instance.  Instances requested with `weak` set only live as long as
+    they're referenced; the others are kept in a pool, which is bounded
+    by `pool_size` instances and `pool_memory` bytes (as estimated by
+    Storage.get_memory_usage()) if either is set, in which case the
+    least recently used repositories are evicted first.  cat-file pipes
+    unused for `idle_pipe_timeout` seconds are closed.
+
+    As the pool is shared by all callers within the process (e.g. by
+    several Trac environments), it's bounded by the most generous
+    budgets any non-weak caller asked for, where 0 (no limit) beats
+    everything.  Likewise, the idle pipe timeout of a repository is the
+    most generous one asked for by the callers sharing its instance.
+    Evictions and closing idle pipes are taken care of by a background
+    thread, so that they happen even if no further instances are
+    requested.
+    """
+
     __dict = weakref.WeakValueDictionary()
-    __dict_nonweak = dict()
+    __pool = dict() # repo -> (Storage instance, time of last use)
     __dict_lock = Lock()
 
-    def __init__(self, repo, log, weak=True, git_bin='git', git_fs_encoding=None):
+    # budgets; None until requested
+    __pool_size = None
+    __pool_memory = None
+    __idle_pipe_timeouts = {} # repo -> seconds
+
+    __MAINTENANCE_INTERVAL = 1 # seconds
+    __MEMORY_CHECK_INTERVAL = 60 # seconds
+    __last_memory_check = 0
+    __maintainer = None
+
+    def __init__(self, repo, log, weak=True, git_bin='git', git_fs_encoding=None,
+                 rev_cache_max_staleness=0, changes_cache_dir=None, ref_filter=None,
+                 trace_file=None, combined_merge_changes=False,
+                 rename_limit=0, rename_timeout=0, renames_file=None, use_committer_time=True,
+                 pool_size=0, pool_memory=0, idle_pipe_timeout=0):
         self.logger = log
 
+        repo = os.path.normcase(os.path.realpath(repo))
+
         with StorageFactory.__dict_lock:
             try:
                 i = StorageFactory.__dict[repo]
             except KeyError:
-                i = Storage(repo, log, git_bin, git_fs_encoding)
+                i = Storage(repo, log, git_bin, git_fs_encoding,
+                            rev_cache_max_staleness=rev_cache_max_staleness,
+                            changes_cache_dir=changes_cache_dir,
+                            ref_filter=ref_filter,
+                            tracer=trace_file and StorageTracer.get(trace_file) or None,
+                            combined_merge_changes=combined_merge_changes,
+                            rename_limit=rename_limit,
+                            rename_timeout=rename_timeout,
+                            renames_file=renames_file,
+                            use_committer_time=use_committer_time)
                 StorageFactory.__dict[repo] = i
 
                 # create or remove additional reference depending on 'weak' argument
                 if weak:
-                    try:
-                        del StorageFactory.__dict_nonweak[repo]
-                    except KeyError:
-                        pass
-                else:
-                    StorageFactory.__dict_nonweak[repo] = i
+                    StorageFactory.__pool.pop(repo, None)
+
+            if not weak or repo in StorageFactory.__pool:
+                StorageFactory.__pool[repo] = (i, time.time())
+
+            generous = StorageFactory.__generous
+            if not weak:
+                StorageFactory.__pool_size = generous(StorageFactory.__pool_size, pool_size)
+                StorageFactory.__pool_memory = generous(StorageFactory.__pool_memory, pool_memory)
+            timeouts = StorageFactory.__idle_pipe_timeouts
+            timeouts[repo] = generous(timeouts.get(repo), idle_pipe_timeout)
+
+            if StorageFactory.__maintainer is None and \
+                    (StorageFactory.__pool_size or StorageFactory.__pool_memory or timeouts[repo]):
+                t = Thread(target=StorageFactory.__maintenance_loop, args=(log,),
+                           name="PyGIT maintenance")
+                t.setDaemon(True)
+                t.start()
+                StorageFactory.__maintainer = t
 
         self.__inst = i
         self.__repo = repo
 
+    @staticmethod
+    def __generous(current, requested):
+        "returns the more generous of two budgets, where 0 means no limit"
+
+        if current is None:
+            return requested
+        if not current or not requested:
+            return 0
+        return max(current, requested)
+
+    @classmethod
+    def __maintenance_loop(cls, log):
+        while True:
+            time.sleep(cls.__MAINTENANCE_INTERVAL)
+            try:
+                cls.__maintain(log)
+            except Exception, e:
+                log.warning("PyGIT.Storage maintenance failed: %s" % e)
+
+    @classmethod
+    def __maintain(cls, log):
+        "evicts pooled instances beyond budget and closes idle pipes"
+
+        now = time.time()
+        with cls.__dict_lock:
+            check_memory = cls.__pool_memory > 0 and \
+                now - cls.__last_memory_check >= cls.__MEMORY_CHECK_INTERVAL
+            if check_memory:
+                cls.__last_memory_check = now
+
+            # most recently used first
+            pool = sorted(cls.__pool.iteritems(), key=lambda e: e[1][1], reverse=True)
+            instances = cls.__dict.items()
+
+            # forget about repositories whose instances are gone
+            for repo in set(cls.__idle_pipe_timeouts) - set(repo for repo, _ in instances):
+                del cls.__idle_pipe_timeouts[repo]
+            timeouts = dict(cls.__idle_pipe_timeouts)
+
+        evict = []
+        if cls.__pool_size > 0:
+            evict.extend(pool[cls.__pool_size:])
+            pool = pool[:cls.__pool_size]
+
+        if check_memory:
+            total = 0
+            for n, entry in enumerate(pool):
+                total += sum(entry[1][0].get_memory_usage().itervalues())
+                if n and total > cls.__pool_memory: # always keep the most recent one
+                    evict.append(entry)
+
+        if evict:
+            with cls.__dict_lock:
+                for repo, (inst, used) in evict:
+                    # unless used again in the meantime
+                    if cls.__pool.get(repo, (None, None))[1] == used:
+                        del cls.__pool[repo]
+            log.debug("evicted PyGIT.Storage instances for %s from pool"
+                      % ", ".join("'%s'" % repo for repo, _ in evict))
+
+        for repo, inst in instances:
+            if timeouts.get(repo) > 0:
+                inst.close_idle_pipe(timeouts[repo])
+
+    @classmethod
+    def get_memory_usage(cls):
+        """
+        returns dict mapping repository paths of all live Storage
+        instances to their `Storage.get_memory_usage()` breakdown
+        """
+
+        with cls.__dict_lock:
+            instances = cls.__dict.items()
+
+        return dict((repo, inst.get_memory_usage()) for repo, inst in instances)
+
+    @classmethod
+    def get_total_memory_usage(cls):
+        "returns `Storage.get_memory_usage()` breakdown summed up over all live instances"
+
+        result = {}
+        for usage in cls.get_memory_usage().itervalues():
+            for k, v in usage.iteritems():
+                result[k] = result.get(k, 0) + v
+        return result
+
     def getInstance(self):
-        is_weak = self.__repo not in StorageFactory.__dict_nonweak
+        is_weak = self.__repo not in StorageFactory.__pool
         self.logger.debug("requested %sPyGIT.Storage instance %d for '%s'"
                           % (("","weak ")[is_weak], id(self.__inst), self.__repo))
         return self.__inst
@@ -165,7 +872,8 @@ class Storage(object):
 
     __SREV_MIN = 4 # minimum short-rev length
 
-    RevCache = namedtuple('RevCache', 'youngest_rev oldest_rev rev_dict tag_set srev_dict branch_dict')
+    RevCache = namedtuple('RevCache', 'youngest_rev oldest_rev rev_dict tag_set srev_dict branch_dict'
+                                      ' time_stamps time_revs author_index committer_index')
 
     @staticmethod
     def __rev_key(rev):
@@ -208,7 +916,11 @@ class Storage(object):
                            " (tried to execute/parse '%s --version' but got %s)"
                            % (git_bin, repr(e)))
 
-    def __init__(self, git_dir, log, git_bin='git', git_fs_encoding=None):
+    def __init__(self, git_dir, log, git_bin='git', git_fs_encoding=None,
+                 rev_cache_max_staleness=0, changes_cache_dir=None, ref_filter=None,
+                 tracer=None, combined_merge_changes=False,
+                 rename_limit=0, rename_timeout=0, renames_file=None,
+                 use_committer_time=True):
         """
         Initialize PyGit.Storage instance
 
@@ -225,6 +937,46 @@ class Storage(object):
                 unicode objects is performed, and bytestrings are
                 returned instead
 
+        `rev_cache_max_staleness`: number of seconds an outdated revision
+                cache may still be served while a new one is rebuilt in
+                the background; 0 rebuilds it synchronously on next access
+
+        `changes_cache_dir`: folder for persisting the change lists of
+                commits across processes and restarts; may be shared by
+                several repositories (`None` disables the on-disk cache)
+
+        `ref_filter`: list of glob patterns of ref names (e.g.
+                'refs/heads/*') whose commits, branches and tags are to
+                be considered, patterns prefixed with '!' exclude refs;
+                all refs are considered if there are no patterns, and
+                only those not excluded if there are only excludes
+
+        `tracer`: StorageTracer instance recording the calls of the
+                public API of this instance (`None` disables tracing)
+
+        `combined_merge_changes`: if set, the change lists of merge
+                commits only hold the paths differing from all parents
+                (as with `git diff-tree -c`), diffed against the first
+                parent, instead of the union of the diffs against each
+                parent
+
+        `rename_limit`: number of files above which git skips the
+                inexact rename detection (`-l`; 0 uses git's default)
+
+        `rename_timeout`: number of seconds after which the rename
+                detection of a single commit is given up, in which case
+                its changes are listed as additions and deletions
+                (0 disables the limit); applies to the streaming
+                log_changes() and diff_tree_many() as well
+
+        `renames_file`: file recording the commits whose rename
+                detection timed out, so that it isn't tried again by
+                other processes or after restarts (`None` keeps the
+                record in memory only)
+
+        `use_committer_time`: whether history_timerange() selects commits
+                by committer timestamp (default) or by author timestamp
+
         """
 
         self.logger = log
@@ -253,19 +1005,65 @@ class Storage(object):
 
         self.logger.debug("PyGIT.Storage instance %d constructed" % id(self))
 
-        self.repo = GitCore(git_dir, git_bin=git_bin)
+        self.repo = GitCore(git_dir, git_bin=git_bin, log=log)
 
         self.commit_encoding = None
 
-        # caches
-        self.__rev_cache = None
-        self.__rev_cache_lock = Lock()
+        includes = [ p for p in ref_filter or () if not p.startswith('!') ]
+        excludes = [ p[1:] for p in ref_filter or () if p.startswith('!') ]
+        self.__ref_filter = (includes or excludes) and (includes, excludes) or None
 
-        # cache the last 200 commit messages
-        self.__commit_msg_cache = SizedDict(200)
-        self.__commit_msg_lock = Lock()
+        # caches
+        self.__rev_cache = None # immutable snapshot, read w/o locking
+        self.__rev_cache_lock = Lock() # serializes rebuilds
+        self.__rev_cache_state_lock = Lock()
+        self.__rev_cache_stale = None # time current snapshot was invalidated
+        self.__rev_cache_gen = 0 # incremented for every change detected
+        self.__rev_cache_refreshing = False
+        self.__rev_cache_max_staleness = rev_cache_max_staleness
+        self.__rev_cache_usage = (None, None) # (rev_cache, usage) memo
+
+        # cache the last 200 commits
+        self.__commit_cache = SizedDict(200)
+        self.__commit_lock = Lock()
+
+        # cache of commit message beginnings, as used for link titles
+        self.__commit_title_cache = SizedDict(5000)
+
+        # beginnings of the 1000 most recently sniffed blobs
+        self.__file_prefix_cache = LRUDict(1000)
+
+        # ordered commits touching the 100 most recently navigated paths
+        self.__path_revs_cache = LRUDict(100)
+
+        # cache the change lists of the 500 most recently used commits;
+        # optionally backed by an on-disk cache (keyed by sha and by
+        # whatever affects the result)
+        self.__changes_cache = LRUDict(500)
+        self.__changes_lock = Lock()
+        self.__changes_cache_dir = changes_cache_dir
+        self.__changes_cache_variant = '%s-%s' % (combined_merge_changes and 'C' or 'M',
+                                                  git_fs_encoding or 'raw')
+        self.__combined_merge_changes = combined_merge_changes
+
+        # commits whose rename detection exceeded the budget, mapped to
+        # the reason; diffs of timed out ones are computed without it
+        # from then on
+        self.__rename_limit = rename_limit
+        self.__rename_timeout = rename_timeout
+        self.__renames_skipped = {}
+        self.__renames_timed_out = set()
+        self.__renames_file = renames_file
+        self.__renames_file_mtime = None
+
+        self.__use_committer_time = use_committer_time
 
         self.__cat_file_pipe = None
+        self.__cat_file_lock = Lock()
+        self.__cat_file_used = 0 # time of last use
+
+        if tracer is not None:
+            tracer.instrument(self, git_dir)
 
     def __del__(self):
         if self.__cat_file_pipe is not None:
@@ -280,133 +1078,439 @@ class Storage(object):
     def __rev_cache_sync(self, youngest_rev=None):
         "invalidates revision db cache if necessary"
 
-        with self.__rev_cache_lock:
-            need_update = False
-            if self.__rev_cache:
-                last_youngest_rev = self.__rev_cache.youngest_rev
-                if last_youngest_rev != youngest_rev:
-                    self.logger.debug("invalidated caches (%s != %s)" % (last_youngest_rev, youngest_rev))
-                    need_update = True
-            else:
-                need_update = True # almost NOOP
+        with self.__rev_cache_state_lock:
+            _rev_cache = self.__rev_cache
+            if _rev_cache and _rev_cache.youngest_rev == youngest_rev:
+                return False
+
+            # mark current snapshot as stale; it's still served to
+            # readers until it's replaced or becomes too old
+            self.__rev_cache_gen += 1
+            if self.__rev_cache_stale is None:
+                self.__rev_cache_stale = time.time()
 
-            if need_update:
-                self.__rev_cache = None
+        if _rev_cache:
+            self.logger.debug("invalidated caches (%s != %s)" % (_rev_cache.youngest_rev, youngest_rev))
+            if self.__rev_cache_max_staleness > 0:
+                self.__rev_cache_refresh_async()
 
-            return need_update
+        return True # almost NOOP if there was no cache yet
 
-    def get_rev_cache(self):
+    def get_rev_cache(self, fresh=False):
         """
         Retrieve revision cache
 
-        may rebuild cache on the fly if required
+        returns the current RevCache snapshot without locking; if the
+        snapshot has been invalidated by Storage.sync() more than
+        `rev_cache_max_staleness` seconds ago (or right away if
+        `fresh` is set), waits for it to be rebuilt
 
         returns RevCache tuple
         """
 
+        _rev_cache = self.__rev_cache
+        if _rev_cache is not None:
+            stale = self.__rev_cache_stale
+            if stale is None:
+                return _rev_cache
+            if not fresh and time.time() - stale < self.__rev_cache_max_staleness:
+                return _rev_cache
+
+        return self.__rev_cache_refresh()
+
+    # see RevCache namedtuple
+    rev_cache = property(get_rev_cache)
+
+    def __rev_cache_refresh(self):
+        "rebuild revision cache unless already up to date"
+
         with self.__rev_cache_lock:
-            if self.__rev_cache is None: # can be cleared by Storage.__rev_cache_sync()
-                self.logger.debug("triggered rebuild of commit tree db for %d" % id(self))
-                ts0 = time.time()
+            with self.__rev_cache_state_lock:
+                _rev_cache = self.__rev_cache
+                stale = self.__rev_cache_stale
+                gen = self.__rev_cache_gen
+
+            if _rev_cache is not None and stale is None:
+                return _rev_cache # rebuilt in the meantime
+
+            _rev_cache = self.__rev_cache_build()
+
+            # atomically update self.__rev_cache
+            with self.__rev_cache_state_lock:
+                self.__rev_cache = _rev_cache
+                if self.__rev_cache_gen == gen: # no changes detected while rebuilding
+                    self.__rev_cache_stale = None
+
+            return _rev_cache
+
+    def __rev_cache_refresh_async(self):
+        "rebuild revision cache in a background thread"
+
+        with self.__rev_cache_state_lock:
+            if self.__rev_cache_refreshing:
+                return
+            self.__rev_cache_refreshing = True
+
+        def refresh():
+            try:
+                while True:
+                    self.__rev_cache_refresh()
+                    with self.__rev_cache_state_lock:
+                        if self.__rev_cache_stale is None:
+                            break
+            except Exception, e:
+                self.logger.error("background rebuild of commit tree db for %d failed: %r"
+                                  % (id(self), e))
+
+            with self.__rev_cache_state_lock:
+                self.__rev_cache_refreshing = False
+
+        t = Thread(target=refresh, name="PyGIT rev cache refresh")
+        t.setDaemon(True)
+        t.start()
+
+    def __rev_cache_build(self):
+        "build new RevCache tuple"
+
+        self.logger.debug("triggered rebuild of commit tree db for %d" % id(self))
+        ts0 = time.time()
+
+        youngest = None
+        oldest = None
+        new_db = {} # db
+        new_sdb = {} # short_rev db
+
+        # the previous snapshot, whose user indices are extended if
+        # history merely grew since
+        old_rev_cache = self.__rev_cache
+
+        # helper for reusing strings (shared with the previous snapshot)
+        __rev_seen = {}
+        if old_rev_cache is not None:
+            __rev_seen = dict((rev, rev) for rev in old_rev_cache.rev_dict)
+        def __rev_reuse(rev):
+            rev = str(rev)
+            return __rev_seen.setdefault(rev, rev)
+
+        refs = self.__get_refs()
+
+        if refs is None:
+            new_tags = set(__rev_reuse(rev.strip()) for rev in self.repo.rev_parse("--tags").splitlines())
+        else:
+            new_tags = set(__rev_reuse(sha) for refname, sha in refs if refname.startswith('refs/tags/'))
+
+        new_branches = [(k, __rev_reuse(v)) for k, v in self._get_branches()]
+        head_revs = set(v for _, v in new_branches)
+
+        # (timestamp, -ordinal_id, rev, author email, committer email)
+        # for the sorted time index and the user indices
+        time_keys = []
+        time_field = int(not self.__use_committer_time)
+
+        # helper for reusing (normalized) email addresses
+        __email_seen = {}
+        def __email_reuse(email):
+            email = email.lower()
+            return __email_seen.setdefault(email, email)
+
+        lines = self.__rev_list_refs(refs, "--parents", "--topo-order",
+                                     "--pretty=format:%ct %at%x09%ae%x09%ce").splitlines()
+
+        rev = ord_rev = 0
+        for ord_rev, (revs, info) in enumerate(izip(lines[::2], lines[1::2])):
+            # "commit <rev> <parents>..." followed by
+            # "<committer time> <author time>\t<author email>\t<committer email>"
+            revs = map(__rev_reuse, revs.split()[1:])
+
+            rev = revs[0]
+
+            # first rev seen is assumed to be the youngest one
+            if not ord_rev:
+                youngest = rev
+
+            # shortrev "hash" map
+            srev_key = self.__rev_key(rev)
+            new_sdb.setdefault(srev_key, []).append(rev)
+
+            # parents
+            parents = tuple(revs[1:])
 
-                youngest = None
-                oldest = None
-                new_db = {} # db
-                new_sdb = {} # short_rev db
+            # new_db[rev] = (children(rev), parents(rev), ordinal_id(rev), rheads(rev))
+            if rev in new_db:
+                # (incomplete) entry was already created by children
+                _children, _parents, _ord_rev, _rheads = new_db[rev]
+                assert _children
+                assert not _parents
+                assert _ord_rev == 0
+
+                if rev in head_revs and rev not in _rheads:
+                    _rheads.append(rev)
+
+            else: # new entry
+                _children = []
+                _rheads = [rev] if rev in head_revs else []
+
+            # create/update entry -- transform lists into tuples since entry will be final
+            new_db[rev] = tuple(_children), tuple(parents), ord_rev + 1, tuple(_rheads)
+
+            stamps, author, committer = info.split('\t')
+            time_keys.append((int(stamps.split()[time_field]), -ord_rev, rev,
+                              __email_reuse(author), __email_reuse(committer)))
+
+            # update parents(rev)s
+            for parent in parents:
+                # by default, a dummy ordinal_id is used for the mean-time
+                _children, _parents, _ord_rev, _rheads2 = new_db.setdefault(parent, ([], [], 0, []))
+
+                # update parent(rev)'s children
+                if rev not in _children:
+                    _children.append(rev)
+
+                # update parent(rev)'s rheads
+                for rev in _rheads:
+                    if rev not in _rheads2:
+                        _rheads2.append(rev)
+
+        # last rev seen is assumed to be the oldest one (with highest ord_rev)
+        oldest = rev
+
+        lines = None
+
+        # commits ordered by time, and topologically within the same second
+        time_keys.sort()
+        new_time_stamps = array('d', (k[0] for k in time_keys))
+        new_time_revs = tuple(k[2] for k in time_keys)
+
+        # map identities to their commits; only the identities of
+        # commits added since the previous snapshot need to be updated,
+        # unless commits have vanished in the meantime
+        new_author_index = new_committer_index = {}
+        if old_rev_cache is not None:
+            old_db = old_rev_cache.rev_dict
+            added_keys = [ k for k in time_keys if k[2] not in old_db ]
+            if len(new_db) - len(added_keys) == len(old_db):
+                time_keys = added_keys
+                new_author_index = old_rev_cache.author_index
+                new_committer_index = old_rev_cache.committer_index
+            added_keys = old_db = None
+
+        new_author_index = self.__user_index_update(new_author_index, time_keys, 3)
+        new_committer_index = self.__user_index_update(new_committer_index, time_keys, 4)
+
+        time_keys = __email_seen = None
+
+        __rev_seen = None
+
+        # convert sdb either to dict or array depending on size
+        tmp = [()]*(max(new_sdb.keys())+1) if len(new_sdb) > 5000 else {}
+
+        try:
+            while True:
+                k, v = new_sdb.popitem()
+                tmp[k] = tuple(v)
+        except KeyError:
+            pass
+
+        assert len(new_sdb) == 0
+        new_sdb = tmp
+
+        ts1 = time.time()
+        self.logger.debug("rebuilt commit tree db for %d with %d entries (took %.1f ms)"
+                          % (id(self), len(new_db), 1000*(ts1-ts0)))
+
+        result = Storage.RevCache(youngest, oldest, new_db, new_tags, new_sdb, new_branches,
+                                  new_time_stamps, new_time_revs,
+                                  new_author_index, new_committer_index)
+
+        assert all(e is not None for e in result) or not any(result)
+
+        return result
+
+    @staticmethod
+    def __user_index_update(index, time_keys, field):
+        """
+        returns copy of user `index`, which maps email addresses to the
+        (timestamps, revs) of their commits ordered by time, with the
+        commits of the sorted `time_keys` added under their email
+        address at position `field`
+        """
+
+        added = {}
+        for key in time_keys:
+            added.setdefault(key[field], []).append(key)
+
+        result = dict(index)
+        for email, keys in added.iteritems():
+            stamps, revs = result.get(email, ((), ()))
+            entries = zip(stamps, revs) + [ (k[0], k[2]) for k in keys ]
+            entries.sort(key=itemgetter(0)) # stable, older commits of the same second stay first
+            result[email] = (array('d', (e[0] for e in entries)), tuple(e[1] for e in entries))
+
+        return result
+
+    def warmup(self):
+        "populate revision cache and start cat-file pipe ahead of time"
+
+        self.get_rev_cache()
+
+        with self.__cat_file_lock:
+            self.__get_cat_file_pipe()
+
+    def warmup_commits(self, shas, workers=1):
+        """
+        read commit records and change lists of the commits `shas`
+        (e.g. just pushed ones) into the caches ahead of time; the
+        diffs are computed by `workers` concurrent processes
+        """
+
+        for sha in shas:
+            self.get_commit(sha)
+
+        missing = [ sha for sha in shas if sha not in self.__changes_cache ]
+        for sha, parent_changes in self.diff_tree_many(missing, workers):
+            self.__set_commit_changes(sha, parent_changes)
+
+    @staticmethod
+    def last_update_time(git_dir):
+        """
+        returns most recent modification time of the refs stored in
+        `git_dir` (as approximation for the time of the last push),
+        or 0 if it can't be determined
+        """
+
+        mtimes = [0]
+        for p in ('refs', 'refs/heads', 'refs/tags', 'packed-refs', 'FETCH_HEAD'):
+            try:
+                mtimes.append(os.stat(os.path.join(git_dir, p)).st_mtime)
+            except OSError:
+                pass
+
+        return max(mtimes)
+
+    def get_memory_usage(self):
+        """
+        Estimate memory footprint of in-memory caches
+
+        returns dict mapping cache names ('rev_dict', 'srev_dict',
+        'tag_set', 'branch_dict', 'time_index', 'user_index',
+        'commit_cache', 'commit_title_cache', 'changes_cache',
+        'file_prefix_cache')
+        to their estimated size in bytes; strings shared between caches
+        are only accounted for once (in the first cache listed)
+        """
+
+        seen = set()
 
-                # helper for reusing strings
-                __rev_seen = {}
-                def __rev_reuse(rev):
-                    rev = str(rev)
-                    return __rev_seen.setdefault(rev, rev)
+        _rev_cache = self.__rev_cache
+        memo_rev_cache, usage = self.__rev_cache_usage
+        if _rev_cache is None:
+            usage = dict(rev_dict=0, srev_dict=0, tag_set=0, branch_dict=0, time_index=0,
+                         user_index=0)
+        elif memo_rev_cache is not _rev_cache:
+            # the revision cache is immutable; only walk it once
+            usage = {}
+            for name in ('rev_dict', 'srev_dict', 'tag_set', 'branch_dict'):
+                usage[name] = _deep_sizeof(getattr(_rev_cache, name), seen)
+            usage['time_index'] = sum(_deep_sizeof(getattr(_rev_cache, name), seen)
+                                      for name in ('time_stamps', 'time_revs'))
+            usage['user_index'] = sum(_deep_sizeof(getattr(_rev_cache, name), seen)
+                                      for name in ('author_index', 'committer_index'))
+            self.__rev_cache_usage = (_rev_cache, usage)
+        else:
+            # rev strings are owned by rev_dict
+            seen.update(map(id, _rev_cache.rev_dict))
 
-                new_tags = set(__rev_reuse(rev.strip()) for rev in self.repo.rev_parse("--tags").splitlines())
+        usage = dict(usage)
 
-                new_branches = [(k, __rev_reuse(v)) for k, v in self._get_branches()]
-                head_revs = set(v for _, v in new_branches)
+        usage['commit_cache'] = _deep_sizeof(self.__commit_cache, seen)
 
-                rev = ord_rev = 0
-                for ord_rev, revs in enumerate(self.repo.rev_list("--parents",
-                                                                  "--topo-order",
-                                                                  "--all").splitlines()):
-                    revs = map(__rev_reuse, revs.strip().split())
+        usage['commit_title_cache'] = _deep_sizeof(self.__commit_title_cache, seen)
 
-                    rev = revs[0]
+        usage['changes_cache'] = _deep_sizeof(self.__changes_cache, seen)
 
-                    # first rev seen is assumed to be the youngest one
-                    if not ord_rev:
-                        youngest = rev
+        usage['file_prefix_cache'] = _deep_sizeof(self.__file_prefix_cache, seen)
 
-                    # shortrev "hash" map
-                    srev_key = self.__rev_key(rev)
-                    new_sdb.setdefault(srev_key, []).append(rev)
+        return usage
 
-                    # parents
-                    parents = tuple(revs[1:])
+    def __get_refs(self):
+        """
+        returns list of (refname, sha) tuples of the refs matching
+        `ref_filter`, or None if all refs are to be considered
+        """
 
-                    # new_db[rev] = (children(rev), parents(rev), ordinal_id(rev), rheads(rev))
-                    if rev in new_db:
-                        # (incomplete) entry was already created by children
-                        _children, _parents, _ord_rev, _rheads = new_db[rev]
-                        assert _children
-                        assert not _parents
-                        assert _ord_rev == 0
+        if self.__ref_filter is None:
+            return None
 
-                        if rev in head_revs and rev not in _rheads:
-                            _rheads.append(rev)
+        result = []
+        for line in self.repo.for_each_ref("--format=%(objectname) %(refname)").splitlines():
+            sha, refname = line.split(' ', 1)
+            if self.__ref_matches(refname):
+                result.append((refname, sha))
 
-                    else: # new entry
-                        _children = []
-                        _rheads = [rev] if rev in head_revs else []
+        return result
 
-                    # create/update entry -- transform lists into tuples since entry will be final
-                    new_db[rev] = tuple(_children), tuple(parents), ord_rev + 1, tuple(_rheads)
+    def __ref_matches(self, refname):
+        if self.__ref_filter is None:
+            return True
 
-                    # update parents(rev)s
-                    for parent in parents:
-                        # by default, a dummy ordinal_id is used for the mean-time
-                        _children, _parents, _ord_rev, _rheads2 = new_db.setdefault(parent, ([], [], 0, []))
+        includes, excludes = self.__ref_filter
+        if includes and not any(fnmatchcase(refname, p) for p in includes):
+            return False
+        return not any(fnmatchcase(refname, p) for p in excludes)
 
-                        # update parent(rev)'s children
-                        if rev not in _children:
-                            _children.append(rev)
+    def __rev_list_refs(self, refs, *args, **kw):
+        """
+        like `git rev-list <args> --all [-- <paths>]`, but restricted
+        to the given (refname, sha) tuples unless `refs` is None
+        """
 
-                        # update parent(rev)'s rheads
-                        for rev in _rheads:
-                            if rev not in _rheads2:
-                                _rheads2.append(rev)
+        if refs is not None and not refs:
+            return '' # `git rev-list --stdin` would complain about missing revisions
 
-                # last rev seen is assumed to be the oldest one (with highest ord_rev)
-                oldest = rev
+        paths = tuple(kw.get('paths', ()))
+        if paths:
+            paths = ('--',) + paths
 
-                __rev_seen = None
+        if refs is None:
+            return self.repo.rev_list(*(args + ('--all',) + paths))
 
-                # convert sdb either to dict or array depending on size
-                tmp = [()]*(max(new_sdb.keys())+1) if len(new_sdb) > 5000 else {}
+        return self.repo.rev_list(*(args + ('--stdin',) + paths),
+                                  input=''.join('%s\n' % sha for _, sha in refs))
 
-                try:
-                    while True:
-                        k, v = new_sdb.popitem()
-                        tmp[k] = tuple(v)
-                except KeyError:
-                    pass
+    def get_ref_heads(self):
+        """
+        returns sorted tuple of the distinct objects the considered refs
+        (and HEAD, unless refs are filtered) point to, i.e. a cheap
+        fingerprint of the repository's history
+        """
 
-                assert len(new_sdb) == 0
-                new_sdb = tmp
+        refs = self.__get_refs()
+        if refs is None:
+            shas = self.repo.show_ref('--head', '-s').split()
+        else:
+            shas = [ sha for _, sha in refs ]
+        return tuple(sorted(set(shas)))
 
-                # atomically update self.__rev_cache
-                self.__rev_cache = Storage.RevCache(youngest, oldest, new_db, new_tags, new_sdb, new_branches)
-                ts1 = time.time()
-                self.logger.debug("rebuilt commit tree db for %d with %d entries (took %.1f ms)"
-                                  % (id(self), len(new_db), 1000*(ts1-ts0)))
+    def revs_between(self, old_heads, heads):
+        """
+        returns list of the commits reachable from `heads` but not from
+        `old_heads` (both as returned by get_ref_heads()), youngest
+        first; old heads which no longer exist are ignored
+        """
 
-            assert all(e is not None for e in self.__rev_cache) or not any(self.__rev_cache)
+        if not heads:
+            return []
 
-            return self.__rev_cache
-        # with self.__rev_cache_lock
+        if old_heads:
+            # `git rev-list` would refuse to exclude missing objects
+            existing = self.repo.cat_file('--batch-check',
+                                          input=''.join('%s\n' % sha for sha in old_heads))
+            old_heads = [ line.split()[0] for line in existing.splitlines()
+                          if not line.endswith(' missing') ]
 
-    # see RevCache namedtuple
-    rev_cache = property(get_rev_cache)
+        return self.repo.rev_list('--topo-order', '--stdin',
+                                  input=''.join(['%s\n' % sha for sha in heads] +
+                                                ['^%s\n' % sha for sha in old_heads])).split()
 
     def _get_branches(self):
         "returns list of (local) branches, with active (= HEAD) one being the first item"
@@ -414,6 +1518,8 @@ class Storage(object):
         result = []
         for e in self.repo.branch("-v", "--no-abbrev").splitlines():
             bname, bsha = e[1:].strip().split()[:2]
+            if not self.__ref_matches('refs/heads/' + bname):
+                continue
             if e.startswith('*'):
                 result.insert(0, (bname, bsha))
             else:
@@ -474,10 +1580,66 @@ class Storage(object):
         # should never be reached if db is consistent
         raise GitError("internal inconsistency detected")
 
-    def hist_next_revision(self, sha):
+    def get_path_revs(self, path):
+        """
+        returns tuple of the ordinal ids (ascending, i.e. youngest
+        first) and the corresponding shas of all commits touching
+        `path`; computed once per path and revision cache snapshot
+        """
+
+        _rev_cache = self.get_rev_cache()
+
+        entry = self.__path_revs_cache.get(path)
+        if entry is not None and entry[0] is _rev_cache:
+            return entry[1]
+
+        db = _rev_cache.rev_dict
+        revs = []
+        for rev in self.__rev_list_refs(self.__get_refs(), "--topo-order",
+                                        paths=[self._fs_from_unicode(path)]).splitlines():
+            try:
+                revs.append((db[rev][2], rev))
+            except KeyError: # not part of this snapshot
+                continue
+        revs.sort()
+
+        result = tuple(o for o, _ in revs), tuple(rev for _, rev in revs)
+        self.__path_revs_cache[path] = (_rev_cache, result)
+
+        return result
+
+    def path_relative_rev(self, sha, path, rel_pos):
+        """
+        returns the next younger (`rel_pos` < 0) or older (`rel_pos` > 0)
+        commit touching `path` relative to `sha`, or None
+        """
+
+        db = self.get_commits()
+
+        if sha not in db:
+            raise GitErrorSha()
+
+        ord_rev = db[sha][2]
+        ords, revs = self.get_path_revs(path)
+
+        if rel_pos < 0:
+            idx = bisect_left(ords, ord_rev) - 1
+        else:
+            idx = bisect_right(ords, ord_rev)
+
+        if 0 <= idx < len(revs):
+            return revs[idx]
+
+        return None
+
+    def hist_next_revision(self, sha, path=None):
+        if path:
+            return self.path_relative_rev(sha, path, -1)
         return self.history_relative_rev(sha, -1)
 
-    def hist_prev_revision(self, sha):
+    def hist_prev_revision(self, sha, path=None):
+        if path:
+            return self.path_relative_rev(sha, path, +1)
         return self.history_relative_rev(sha, +1)
 
     def get_commit_encoding(self):
@@ -491,19 +1653,94 @@ class Storage(object):
         "get current HEAD commit id"
         return self.verifyrev("HEAD")
 
-    def cat_file(self, kind, sha):
+    def __get_cat_file_pipe(self):
+        "returns cat-file pipe, starting it if needed; to be called with __cat_file_lock held"
+
         if self.__cat_file_pipe is None:
             self.__cat_file_pipe = self.repo.cat_file_batch()
+        self.__cat_file_used = time.time()
+        return self.__cat_file_pipe
+
+    def close_idle_pipe(self, timeout):
+        "shuts down the cat-file pipe if it hasn't been used for `timeout` seconds"
+
+        with self.__cat_file_lock:
+            p = self.__cat_file_pipe
+            if p is None or time.time() - self.__cat_file_used < timeout:
+                return False
+            self.__cat_file_pipe = None
+
+        self.logger.debug("closing idle cat-file pipe of PyGIT.Storage instance %d" % id(self))
+        p.stdin.close()
+        p.wait()
+        return True
+
+    def cat_file(self, kind, sha):
+        with self.__cat_file_lock:
+            self.__get_cat_file_pipe()
+
+            ts0 = time.time()
+            self.__cat_file_pipe.stdin.write(sha + '\n')
+            self.__cat_file_pipe.stdin.flush()
+            _sha, _type, _size = self.__cat_file_pipe.stdout.readline().split()
+
+            if _type != kind:
+                raise TracError("internal error (got unexpected object kind '%s')" % k)
+
+            size = int(_size)
+            data = self.__cat_file_pipe.stdout.read(size + 1)[:size]
+
+        self.repo.record('cat-file --batch', time.time() - ts0, size, 0, (sha,))
+        return data
+
+    __CAT_FILE_CHUNK = 256 # keeps stdin writes well below the pipe buffer size
+
+    def cat_file_many(self, kind, shas):
+        """
+        like cat_file() but looks up a list of objects by pipelining
+        the requests through the cat-file pipe
+
+        returns list of object contents (or None for missing objects)
+        """
+
+        result = []
+        nbytes = 0
+        bad_type = None
+
+        with self.__cat_file_lock:
+            self.__get_cat_file_pipe()
+
+            ts0 = time.time()
+            for i in range(0, len(shas), self.__CAT_FILE_CHUNK):
+                chunk = shas[i:i+self.__CAT_FILE_CHUNK]
+
+                self.__cat_file_pipe.stdin.write(''.join(sha + '\n' for sha in chunk))
+                self.__cat_file_pipe.stdin.flush()
 
-        self.__cat_file_pipe.stdin.write(sha + '\n')
-        self.__cat_file_pipe.stdin.flush()
-        _sha, _type, _size = self.__cat_file_pipe.stdout.readline().split()
+                for sha in chunk:
+                    header = self.__cat_file_pipe.stdout.readline().split()
+                    if len(header) != 3: # '<sha> missing'
+                        result.append(None)
+                        continue
 
-        if _type != kind:
-            raise TracError("internal error (got unexpected object kind '%s')" % k)
+                    _sha, _type, _size = header
+                    size = int(_size)
+                    data = self.__cat_file_pipe.stdout.read(size + 1)[:size]
+                    nbytes += size
 
-        size = int(_size)
-        return self.__cat_file_pipe.stdout.read(size + 1)[:size]
+                    # don't bail out before all replies have been consumed
+                    if _type != kind:
+                        bad_type = _type
+
+                    result.append(data)
+
+        self.repo.record('cat-file --batch', time.time() - ts0, nbytes, 0,
+                         ('(%d objects)' % len(shas),))
+
+        if bad_type is not None:
+            raise GitError("internal error (got unexpected object kind '%s')" % bad_type)
+
+        return result
 
     def verifyrev(self, rev):
         "verify/lookup given revision object and return a sha id or None if lookup failed"
@@ -565,6 +1802,49 @@ class Storage(object):
 
         return rev # worst-case, all except the last character match
 
+    def has_rev(self, srev):
+        """
+        in-memory test whether hex string `srev` (a full or abbreviated
+        sha id) may name a commit or tag object, without building the
+        revision cache or calling git
+
+        returns False if `srev` is surely unknown, True if it's known
+        (possibly ambiguously) and None if there's no revision cache to
+        decide on
+
+        while a rebuild is pending, the stale revision cache still knows
+        every older commit; a full sha it doesn't know yields None then,
+        as it may have been pushed since, whereas unknown abbreviated
+        ones are taken to be no commits
+        """
+
+        _rev_cache = self.__rev_cache
+        if _rev_cache is None:
+            return None
+
+        srev = str(srev).lower()
+
+        if len(srev) == 40:
+            if srev in _rev_cache.rev_dict or srev in _rev_cache.tag_set:
+                return True
+            if self.__rev_cache_stale is not None:
+                return None
+            return False
+
+        if not GitCore.is_sha(srev):
+            return False
+
+        try:
+            srevs = _rev_cache.srev_dict[self.__rev_key(srev)]
+        except (KeyError, IndexError):
+            return False
+
+        for rev in srevs:
+            if rev.startswith(srev):
+                return True
+
+        return False
+
     def fullrev(self, srev):
         "try to reverse shortrev()"
         srev = str(srev)
@@ -590,7 +1870,8 @@ class Storage(object):
         return None
 
     def get_tags(self):
-        return [ e.strip() for e in self.repo.tag("-l").splitlines() ]
+        return [ e.strip() for e in self.repo.tag("-l").splitlines()
+                 if self.__ref_matches('refs/tags/' + e.strip()) ]
 
     def ls_tree(self, rev, path=""):
         rev = rev and str(rev) or 'HEAD' # paranoia
@@ -600,7 +1881,11 @@ class Storage(object):
         if path.startswith('/'):
             path = path[1:]
 
-        tree = self.repo.ls_tree("-z", "-l", rev, "--", path).split('\0')
+        ls_tree_args = ["-z", "-l", rev]
+        if path: # recent git versions reject an empty pathspec
+            ls_tree_args.extend(["--", path])
+
+        tree = self.repo.ls_tree(*ls_tree_args).split('\0')
 
         def split_ls_tree_line(l):
             "split according to '<mode> <type> <sha> <size>\t<fname>'"
@@ -617,48 +1902,320 @@ class Storage(object):
 
         return [ split_ls_tree_line(e) for e in tree if e ]
 
-    def read_commit(self, commit_id):
+    def get_commit(self, commit_id):
+        """
+        returns (cached) Commit record for `commit_id`
+
+        the returned object is shared and must not be modified
+        """
+
         if not commit_id:
-            raise GitError("read_commit called with empty commit_id")
+            raise GitError("get_commit called with empty commit_id")
 
         commit_id, commit_id_orig = self.fullrev(commit_id), commit_id
 
         db = self.get_commits()
         if commit_id not in db:
-            self.logger.info("read_commit failed for '%s' ('%s')" %
+            self.logger.info("get_commit failed for '%s' ('%s')" %
                              (commit_id, commit_id_orig))
             raise GitErrorSha
 
-        with self.__commit_msg_lock:
-            if self.__commit_msg_cache.has_key(commit_id):
-                # cache hit
-                result = self.__commit_msg_cache[commit_id]
-                return result[0], dict(result[1])
+        commit = self.__commit_cache.get(commit_id)
+        if commit is not None: # cache hit
+            return commit
+
+        with self.__commit_lock:
+            commit = self.__commit_cache.get(commit_id)
+            if commit is None: # cache miss
+                commit = self.__parse_commit(commit_id, self.cat_file("commit", commit_id))
+                self.__commit_cache[commit_id] = commit
+
+        return commit
+
+    def read_commit(self, commit_id):
+        "returns (message, props) tuple with props mapping header names to lists of values"
+
+        commit = self.get_commit(commit_id)
+
+        props = {}
+        for key, value in commit.headers:
+            props.setdefault(key, []).append(value)
+
+        return commit.message, props
+
+    def __parse_commit(self, commit_id, raw):
+        "parse raw commit object into Commit record"
+
+        return Commit.parse(commit_id, unicode(raw, self.get_commit_encoding(), 'replace'))
+
+    TITLE_LEN = 100 # long enough for trac.util.text.shorten_line()
+
+    def get_commit_changes(self, sha):
+        """
+        returns (cached) list of (parent, changes) tuples, where
+        `changes` holds the diff_tree() tuples (renames detected) of
+        commit `sha` against `parent` (None for root commits); merges
+        only have one combined diff against their first parent if
+        `combined_merge_changes` is set
+        """
+
+        parent_changes = self.__changes_cache.get(sha)
+        if parent_changes is not None:
+            return parent_changes
+
+        parent_changes = self.__load_commit_changes(sha)
+        if parent_changes is not None:
+            with self.__changes_lock:
+                self.__changes_cache[sha] = parent_changes
+            return parent_changes
+
+        return self.__set_commit_changes(sha, self.__diff_commit_parents(sha))
+
+    def __diff_commit_parents(self, sha, parents=None):
+        """
+        returns list of (parent, changes) tuples of commit `sha`, as
+        returned by get_commit_changes() but bypassing the caches
+        """
+
+        if parents is None:
+            parents = self.get_commit(sha).parents
+        if self.__combined_merge_changes and len(parents) > 1:
+            return [ (parents[0], self.diff_tree_combined(sha)) ]
+        return [ (parent, self.__diff_commit(parent, sha))
+                 for parent in parents or [None] ]
+
+    def __diff_commit(self, parent, sha):
+        """
+        returns diff_tree() tuples of commit `sha` against `parent`,
+        detecting renames within `rename_limit` and `rename_timeout`
+        """
+
+        self.__load_renames_timed_out()
+        if sha in self.__renames_timed_out:
+            return list(self.diff_tree(parent, sha))
+
+        try:
+            output, warnings = self.repo.diff_tree(*self.__diff_tree_args(parent, sha, "", True),
+                                                   **dict(timeout=self.__rename_timeout or None,
+                                                          with_stderr=True))
+        except GitTimeout:
+            self.__record_rename_timeout(sha)
+            return list(self.diff_tree(parent, sha))
+
+        # `-l` makes git skip inexact rename detection (with a warning)
+        if 'rename' in warnings:
+            self.__renames_skipped[sha] = warnings.strip()
+            self.logger.info("rename detection for commit %s skipped: %s"
+                             % (sha, warnings.strip()))
+
+        return list(self.__parse_diff_tree(output, parent))
+
+    def __record_rename_timeout(self, sha):
+        "remember (in `renames_file` if set) that rename detection of `sha` timed out"
+
+        reason = "took more than %s s" % self.__rename_timeout
+        self.__renames_timed_out.add(sha)
+        self.__renames_skipped[sha] = reason
+        self.logger.info("rename detection for commit %s skipped: %s" % (sha, reason))
+
+        if not self.__renames_file:
+            return
+
+        try:
+            if not os.path.isdir(os.path.dirname(self.__renames_file)):
+                try:
+                    os.makedirs(os.path.dirname(self.__renames_file))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(self.__renames_file)): # lost no race
+                        raise
+            # single short appends don't interleave with those of other processes
+            f = open(self.__renames_file, 'a')
+            try:
+                f.write('%s %s\n' % (sha, reason))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            self.logger.warning("could not record rename timeout of %s: %s" % (sha, e))
+
+    def __load_renames_timed_out(self):
+        "picks up the rename timeouts recorded in `renames_file` (if changed)"
+
+        if not self.__renames_file:
+            return
+
+        try:
+            mtime = os.stat(self.__renames_file).st_mtime
+        except OSError:
+            return # nothing recorded yet
+
+        if mtime == self.__renames_file_mtime:
+            return
+        self.__renames_file_mtime = mtime
+
+        try:
+            f = open(self.__renames_file)
+            try:
+                for line in f:
+                    sha, _, reason = line.rstrip('\n').partition(' ')
+                    if len(sha) == 40:
+                        self.__renames_timed_out.add(sha)
+                        self.__renames_skipped[sha] = reason
+            finally:
+                f.close()
+        except IOError, e:
+            self.logger.warning("could not read rename timeouts: %s" % e)
+
+    def get_renames_skipped(self):
+        """
+        returns dict mapping the commits whose rename detection exceeded
+        the budget to the reason
+        """
+        self.__load_renames_timed_out()
+        return dict(self.__renames_skipped)
+
+    def __set_commit_changes(self, sha, parent_changes):
+        parent_changes = tuple( (parent, tuple(changes)) for parent, changes in parent_changes )
+        with self.__changes_lock:
+            self.__changes_cache[sha] = parent_changes
+        self.__store_commit_changes(sha, parent_changes)
+        return parent_changes
+
+    def __changes_cache_path(self, sha):
+        return os.path.join(self.__changes_cache_dir, sha[:2],
+                            '%s.%s' % (sha[2:], self.__changes_cache_variant))
+
+    def __load_commit_changes(self, sha):
+        "returns change list of `sha` from on-disk cache (or None)"
+
+        if not self.__changes_cache_dir:
+            return None
+
+        try:
+            f = open(self.__changes_cache_path(sha), 'rb')
+        except IOError:
+            return None # not cached yet
+
+        try:
+            try:
+                return marshal.load(f)
+            finally:
+                f.close()
+        except (EOFError, ValueError, TypeError), e:
+            self.logger.warning("ignoring corrupt change list cache entry for %s: %s" % (sha, e))
+            return None
+
+    def __store_commit_changes(self, sha, parent_changes):
+        "writes change list of `sha` to on-disk cache (if enabled)"
+
+        if not self.__changes_cache_dir:
+            return
+
+        path = self.__changes_cache_path(sha)
+        if os.path.exists(path):
+            return
 
-            # cache miss
-            raw = self.cat_file("commit", commit_id)
-            raw = unicode(raw, self.get_commit_encoding(), 'replace')
-            lines = raw.splitlines()
+        # written to temporary file first, so that readers never see partial entries
+        tmp_path = '%s.%d-%d.tmp' % (path, os.getpid(), id(parent_changes))
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    if not os.path.isdir(os.path.dirname(path)): # lost no race
+                        raise
+            f = open(tmp_path, 'wb')
+            try:
+                marshal.dump(parent_changes, f)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            self.logger.warning("could not write change list cache entry for %s: %s" % (sha, e))
+
+    def get_commit_titles(self, shas):
+        """
+        returns dict mapping those of the given commit ids which exist
+        to the first `TITLE_LEN` characters of their commit message
 
-            if not lines:
-                raise GitErrorSha
+        all cache misses are resolved with one pipelined cat-file lookup
+        """
 
-            line = lines.pop(0)
-            props = {}
-            while line:
-                key, value = line.split(None, 1)
-                props.setdefault(key, []).append(value.strip())
-                line = lines.pop(0)
+        db = self.get_commits()
 
-            result = ("\n".join(lines), props)
+        result = {}
+        missing = []
+        for sha in shas:
+            if sha in result or sha not in db:
+                continue
+
+            title = self.__commit_title_cache.get(sha)
+            if title is None:
+                commit = self.__commit_cache.get(sha)
+                if commit is not None:
+                    title = commit.message[:self.TITLE_LEN]
+
+            if title is None:
+                if sha not in missing:
+                    missing.append(sha)
+            else:
+                result[sha] = title
 
-            self.__commit_msg_cache[commit_id] = result
+        if missing:
+            for sha, raw in zip(missing, self.cat_file_many("commit", missing)):
+                if raw is None:
+                    continue
+                title = self.__parse_commit(sha, raw).message[:self.TITLE_LEN]
+                self.__commit_title_cache[sha] = title
+                result[sha] = title
 
-            return result[0], dict(result[1])
+        return result
 
     def get_file(self, sha):
         return cStringIO.StringIO(self.cat_file("blob", str(sha)))
 
+    FILE_PREFIX_LEN = 1024 # trac.mimeview sniffs the first 1000 bytes
+
+    FILE_PREFIX_BATCH_MAX = 64 * 1024 # blobs up to this size are read via cat-file --batch
+
+    def get_file_prefix(self, sha, size=None):
+        """
+        returns (cached) first `FILE_PREFIX_LEN` bytes of blob `sha`
+        (e.g. for content type detection), without reading the rest
+        of the blob
+
+        small blobs of known `size` are read through the shared
+        cat-file pipe instead of forking a git process
+        """
+
+        sha = str(sha)
+
+        prefix = self.__file_prefix_cache.get(sha)
+        if prefix is not None:
+            return prefix
+
+        if size is not None and size <= self.FILE_PREFIX_BATCH_MAX:
+            prefix = self.cat_file('blob', sha)[:self.FILE_PREFIX_LEN]
+            self.__file_prefix_cache[sha] = prefix
+            return prefix
+
+        ts0 = time.time()
+        p = self.repo.cat_file_pipe('blob', sha)
+        try:
+            prefix = p.stdout.read(self.FILE_PREFIX_LEN)
+        finally:
+            p.stdout.close()
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+            self.repo.record('cat-file blob', time.time() - ts0, len(prefix or ''),
+                             None, (sha,))
+
+        if not prefix and self.get_obj_size(sha) != 0:
+            raise GitErrorSha("object '%s' not found" % sha)
+
+        self.__file_prefix_cache[sha] = prefix
+        return prefix
+
     def get_obj_size(self, sha):
         sha = str(sha)
 
@@ -714,23 +2271,30 @@ class Storage(object):
         return self.get_commits().iterkeys()
 
     def sync(self):
-        rev = self.repo.rev_list("--max-count=1", "--topo-order", "--all").strip()
-        return self.__rev_cache_sync(rev)
+        rev = self.__rev_list_refs(self.__get_refs(), "--max-count=1", "--topo-order").strip()
+        return self.__rev_cache_sync(rev or None) # youngest_rev of empty rev caches is None
 
     @contextmanager
     def get_historian(self, sha, base_path):
         p = []
         change = {}
         next_path = []
+        ts0 = time.time()
+        nbytes = [0]
+
+        # recent git versions reject an empty pathspec
+        path_args = base_path and ('--', base_path) or ()
 
         def name_status_gen():
             p[:] = [self.repo.log_pipe('--pretty=format:%n%H', '--name-status',
-                                       sha, '--', base_path)]
+                                       sha, *path_args)]
             f = p[0].stdout
             for l in f:
+                nbytes[0] += len(l)
                 if l == '\n': continue
                 old_sha = l.rstrip('\n')
                 for l in f:
+                    nbytes[0] += len(l)
                     if l == '\n': break
                     _, path = l.rstrip('\n').split('\t', 1)
                     while path not in change:
@@ -744,21 +2308,30 @@ class Storage(object):
             p[0].terminate()
             p[0].wait()
             p[:] = []
+            self.repo.record('log', time.time() - ts0, nbytes[0], None, (sha,) + path_args)
             while True: yield None
         gen = name_status_gen()
 
+        closed = []
+
         def historian(path):
             try:
                 return change[path]
             except KeyError:
+                if closed: # used after leaving the context
+                    return self.last_change(sha, path)
                 next_path[:] = [path]
                 return gen.next()
-        yield historian
+        try:
+            yield historian
+        finally:
+            closed.append(True)
 
-        if p:
-            p[0].stdout.close()
-            p[0].terminate()
-            p[0].wait()
+            if p:
+                p[0].stdout.close()
+                p[0].terminate()
+                p[0].wait()
+                self.repo.record('log', time.time() - ts0, nbytes[0], None, (sha,) + path_args)
 
     def last_change(self, sha, path, historian=None):
         if historian is not None:
@@ -777,11 +2350,48 @@ class Storage(object):
         return [ rev.strip() for rev in tmp.splitlines() ]
 
     def history_timerange(self, start, stop):
-        return [ rev.strip() for rev in \
-                     self.repo.rev_list("--reverse",
-                                        "--max-age=%d" % start,
-                                        "--min-age=%d" % stop,
-                                        "--all").splitlines() ]
+        """
+        returns the commits with a (committer or author, see
+        `use_committer_time`) timestamp within [`start`, `stop`],
+        oldest first
+        """
+
+        _rev_cache = self.get_rev_cache()
+        times = _rev_cache.time_stamps
+
+        return list(_rev_cache.time_revs[bisect_left(times, start):bisect_right(times, stop)])
+
+    def get_user_commits(self, user, start=None, stop=None, role='author'):
+        """
+        returns the commits authored (or committed, if `role` is
+        'committer') by `user` with a timestamp (see history_timerange())
+        within [`start`, `stop`], oldest first
+
+        `user` is an email address, optionally in 'Name <email>' form,
+        and compared case-insensitively; only the commits of that user
+        are looked at
+        """
+
+        if role not in ('author', 'committer'):
+            raise ValueError("role must be 'author' or 'committer'")
+
+        if '<' in user:
+            user = user.rsplit('<', 1)[1].split('>', 1)[0]
+        user = user.strip().lower()
+
+        _rev_cache = self.get_rev_cache()
+        entry = getattr(_rev_cache, role + '_index').get(user)
+        if not entry:
+            return []
+
+        stamps, revs = entry
+        lo, hi = 0, len(stamps)
+        if start is not None:
+            lo = bisect_left(stamps, start)
+        if stop is not None:
+            hi = bisect_right(stamps, stop)
+
+        return list(revs[lo:hi])
 
     def rev_is_anchestor_of(self, rev1, rev2):
         """return True if rev2 is successor of rev1"""
@@ -794,6 +2404,53 @@ class Storage(object):
         return (rev2 in rev_dict and
                 rev2 in self.children_recursive(rev1, rev_dict))
 
+    ARCHIVE_FORMATS = ('zip', 'tar', 'tar.gz')
+
+    def archive(self, sha, path="", format='zip', prefix=None):
+        """
+        generator streaming the `git archive` of the tree at `path` in
+        commit `sha` in chunks; `format` is one of `ARCHIVE_FORMATS`
+
+        the archive is compressed on the fly, so that memory usage
+        stays bounded; `git archive` is terminated if the generator
+        is closed before being exhausted
+        """
+
+        if format not in self.ARCHIVE_FORMATS:
+            raise GitError("unsupported archive format '%s'" % format)
+
+        path = self._fs_from_unicode(path).strip('/')
+        args = ['--format=%s' % (format == 'zip' and 'zip' or 'tar')]
+        if prefix:
+            args.append('--prefix=%s/' % self._fs_from_unicode(prefix).strip('/'))
+        args.append(path and '%s:%s' % (sha, path) or str(sha))
+
+        compressor = None
+        if format == 'tar.gz':
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip framing
+
+        ts0 = time.time()
+        nbytes = 0
+        p = self.repo.archive_pipe(*args)
+        try:
+            while True:
+                data = p.stdout.read(0x10000)
+                if not data:
+                    break
+                nbytes += len(data)
+                if compressor:
+                    data = compressor.compress(data)
+                if data:
+                    yield data
+            if compressor:
+                yield compressor.flush()
+        finally:
+            p.stdout.close()
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+            self.repo.record('archive', time.time() - ts0, nbytes, p.returncode, tuple(args))
+
     def blame(self, commit_sha, path):
         in_metadata = False
 
@@ -823,15 +2480,29 @@ class Storage(object):
         # diff-tree returns records with the following structure:
         # :<old-mode> <new-mode> <old-sha> <new-sha> <change> NUL <old-path> NUL [ <new-path> NUL ]
 
+        output = self.repo.diff_tree(*self.__diff_tree_args(tree1, tree2, path, find_renames))
+
+        for chg in self.__parse_diff_tree(output, tree1):
+            yield chg
+
+    def __diff_tree_args(self, tree1, tree2, path, find_renames):
         path = self._fs_from_unicode(path).strip("/")
         diff_tree_args = ["-z", "-r"]
         if find_renames:
-            diff_tree_args.append("-M")
+            diff_tree_args.extend(self.__rename_args())
         diff_tree_args.extend([str(tree1) if tree1 else "--root",
-                               str(tree2),
-                               "--", path])
+                               str(tree2)])
+        if path: # recent git versions reject an empty pathspec
+            diff_tree_args.extend(["--", path])
+        return diff_tree_args
+
+    def __rename_args(self):
+        if self.__rename_limit > 0:
+            return ["-M", "-l%d" % self.__rename_limit]
+        return ["-M"]
 
-        lines = self.repo.diff_tree(*diff_tree_args).split('\0')
+    def __parse_diff_tree(self, output, tree1):
+        lines = output.split('\0')
 
         assert lines[-1] == ""
         del lines[-1]
@@ -870,6 +2541,382 @@ class Storage(object):
         if chg:
             yield __chg_tuple()
 
+    def diff_tree_combined(self, sha):
+        """
+        returns the diff_tree() tuples of the paths of merge commit
+        `sha` which differ from all of its parents (`git diff-tree -c`),
+        with the first parent's side as the old one
+        """
+
+        f = cStringIO.StringIO(self.repo.diff_tree('-c', '-r', '-z', '--no-abbrev', sha))
+        changes = []
+        for _, block in self.__raw_diff_blocks(f, [0]):
+            changes.extend(block)
+        return changes
+
+    def __raw_diff_blocks(self, f, nbytes, watchdog=None):
+        """
+        parses NUL-terminated stream of header tokens, each followed by
+        the raw diff records (as emitted with `--raw -z`) belonging to
+        it, and yields (header, [diff_tree() tuples]) per header
+
+        combined diff records of merges (as emitted with `-c`) are
+        reduced to the first parent's side; headers may be marked with
+        a leading \\x01; the number of bytes read is accumulated in
+        `nbytes[0]`
+
+        if a _StallWatchdog is given, `f` is read as soon as data
+        arrives, and the last (possibly truncated) block is dropped if
+        the watchdog fired
+        """
+
+        def read():
+            if watchdog is None:
+                return f.read(0x10000)
+            watchdog.arm()
+            try:
+                return os.read(f.fileno(), 0x10000)
+            finally:
+                watchdog.disarm()
+
+        def tokens():
+            rest = ''
+            while True:
+                data = read()
+                if not data:
+                    break
+                nbytes[0] += len(data)
+                tokens = (rest + data).split('\0')
+                rest = tokens.pop()
+                for token in tokens:
+                    yield token
+            if rest:
+                yield rest
+
+        header = chg = None
+        changes = []
+        paths = 0
+        for token in tokens():
+            if paths:
+                chg.append(self._fs_to_unicode(token))
+                paths -= 1
+                if not paths:
+                    if len(chg) == 6:
+                        chg.append(None)
+                    changes.append(tuple(chg))
+                continue
+
+            token = token.lstrip('\n')
+            if token.startswith('::'):
+                # ::<mode per parent> <new-mode> <sha per parent> <new-sha> <status per parent>
+                fields = token[2:].split()
+                n = len(fields[-1])
+                chg = [fields[0], fields[n], fields[n+1], fields[2*n+1], fields[-1][0]]
+                paths = 1
+            elif token.startswith(':'):
+                chg = token[1:].split()
+                assert len(chg) == 5
+                paths = chg[4][0] in 'RC' and 2 or 1
+            elif token:
+                if header is not None:
+                    yield header, changes
+                header, changes = token.lstrip('\x01'), []
+
+        if header is not None and not (watchdog and watchdog.fired):
+            yield header, changes
+
+    __STALL_FALLBACK = 50 # max. number of commits diffed one by one after a stream got stuck
+
+    def __capped_changes(self, shas, stream, fallback):
+        """
+        yields the items of `stream(shas, stalled)` for the commits in
+        `shas` (in that order); `stream` stops early, appending to the
+        `stalled` list, if git got stuck for more than `rename_timeout`,
+        in which case the following commits are diffed one by one with
+        `fallback(sha)` up to the one exceeding the timeout, before
+        streaming the rest; commits known to exceed it aren't streamed
+        """
+
+        self.__load_renames_timed_out()
+        timed_out = self.__renames_timed_out
+
+        i = 0
+        while i < len(shas):
+            if shas[i] in timed_out:
+                yield fallback(shas[i])
+                i += 1
+                continue
+
+            j = i + 1
+            while j < len(shas) and shas[j] not in timed_out:
+                j += 1
+
+            stalled = []
+            for item in stream(shas[i:j], stalled):
+                yield item
+                i += 1
+
+            if not stalled:
+                i = j
+                continue
+
+            self.logger.info("git got stuck after %d of %d commits, diffing them one by one"
+                             % (i, len(shas)))
+            for sha in shas[i:i + self.__STALL_FALLBACK]:
+                yield fallback(sha)
+                i += 1
+                if sha in timed_out:
+                    break
+
+    # header of each (per-parent) diff block emitted by log_changes()
+    __LOG_CHANGES_FORMAT = '%x01%H%n%T%n%P%n%an <%ae> %ad%n%cn <%ce> %cd%n%B'
+
+    def log_changes(self, revs=None, with_changes=True):
+        """
+        yields (Commit, [(parent, changes), ...]) tuples for all
+        commits, oldest first, or just for the commits in `revs`, in
+        that order; `changes` holds the diff_tree() tuples (renames
+        detected) against `parent`, which is None for root commits
+
+        commit metadata and raw change records are read from a single
+        streaming `git log --raw` invocation; the `headers` of the
+        yielded Commit records only hold tree, parents, author and
+        committer
+
+        if `with_changes` is false, no diffs are computed and (Commit,
+        None) tuples are yielded
+
+        if `rename_timeout` is set, the stream is restarted behind
+        commits exceeding it, whose changes are then listed without
+        rename detection, just like with get_commit_changes()
+        """
+
+        if not (with_changes and self.__rename_timeout > 0):
+            return self.__log_changes(revs, with_changes)
+
+        if revs is None:
+            rev_dict = self.get_commits()
+            revs = sorted(rev_dict, key=lambda rev: rev_dict[rev][2], reverse=True)
+
+        return self.__capped_changes(list(revs),
+                                     lambda revs, stalled: self.__log_changes(revs, True, stalled),
+                                     lambda sha: (self.get_commit(sha),
+                                                  self.__diff_commit_parents(sha)))
+
+    def __log_changes(self, revs, with_changes, stalled=None):
+        "log_changes() backend; stops early setting `stalled` if git gets stuck (see __capped_changes())"
+
+        args = ['-z', '--no-color', '--date=raw',
+                '--encoding=%s' % self.get_commit_encoding(),
+                '--format=' + self.__LOG_CHANGES_FORMAT]
+        if with_changes:
+            args.extend(['--raw', self.__combined_merge_changes and '-c' or '-m',
+                         '--root', '--no-abbrev'] + self.__rename_args())
+        refs = None
+        if revs is None:
+            refs = self.__get_refs()
+        if revs is None and refs is None:
+            args.extend(['--reverse', '--topo-order', '--all'])
+            p = self.repo.log_pipe(*args)
+        elif revs is None:
+            if not refs:
+                return # no refs left, `git log` would fall back to HEAD
+            args.extend(['--reverse', '--topo-order', '--stdin'])
+            p = self.repo.log_pipe(*args, stdin=PIPE)
+            p.stdin.write(''.join('%s\n' % sha for _, sha in refs))
+            p.stdin.close()
+        else:
+            args.extend(['--no-walk=unsorted', '--stdin'])
+            p = self.repo.log_pipe(*args, stdin=PIPE)
+            # git reads all of stdin before writing any output
+            p.stdin.write(''.join('%s\n' % rev for rev in revs))
+            p.stdin.close()
+
+        ts0 = time.time()
+        nbytes = [0]
+        enc = self.get_commit_encoding()
+        watchdog = stalled is not None and _StallWatchdog(p, self.__rename_timeout) or None
+
+        def commit_from_header(header):
+            sha, tree, parents, author, committer, message = header.split('\n', 5)
+            author, committer = [ unicode(u, enc, 'replace') for u in (author, committer) ]
+            parents = tuple(parents.split())
+            headers = (('tree', tree),) + tuple(('parent', p) for p in parents) + \
+                (('author', author), ('committer', committer))
+            author, author_time = parse_user_time(author)
+            committer, committer_time = parse_user_time(committer)
+            message = u'\n'.join(unicode(message, enc, 'replace').splitlines())
+            return Commit(sha, tree, parents, author, author_time,
+                          committer, committer_time, message, headers)
+
+        try:
+            commit = None
+            parent_changes = []
+            for header, changes in self.__raw_diff_blocks(p.stdout, nbytes, watchdog):
+                sha = header[:40]
+                if commit is None or commit.sha != sha:
+                    if commit is not None:
+                        yield commit, self.__complete_parent_changes(commit, parent_changes,
+                                                                     with_changes)
+                    commit = commit_from_header(header)
+                    parent_changes = []
+                parent_changes.append(changes)
+
+            if watchdog is not None and watchdog.fired:
+                stalled.append(True) # the last commit may be incomplete
+            elif commit is not None:
+                yield commit, self.__complete_parent_changes(commit, parent_changes,
+                                                             with_changes)
+
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+            p.stdout.close()
+            p.terminate()
+            p.wait()
+            self.repo.record('log', time.time() - ts0, nbytes[0], None, ('--raw',))
+
+    def __complete_parent_changes(self, commit, parent_changes, with_changes=True):
+        "pairs up diff blocks emitted by `git log -m` (or `-c`) with the commit's parents"
+
+        if not with_changes:
+            return None
+
+        parents = commit.parents or (None,)
+        if self.__combined_merge_changes and len(parents) > 1:
+            if len(parent_changes) == 1:
+                return [ (parents[0], parent_changes[0]) ]
+            return [ (parents[0], self.diff_tree_combined(commit.sha)) ]
+
+        if len(parent_changes) == len(parents):
+            return zip(parents, parent_changes)
+
+        # `git log -m` omits the blocks of merge parents without
+        # differences; diff those merges separately
+        return [ (parent, self.__diff_commit(parent, commit.sha))
+                 for parent in parents ]
+
+    def diff_tree_many(self, shas, workers=2):
+        """
+        yields (sha, [(parent, changes), ...]) tuples for the commits in
+        `shas`, in that order, just like log_changes()
+
+        the diffs are computed concurrently by a pool of `workers`
+        `git diff-tree --stdin` processes, each of which is fed with
+        every `workers`-th commit; `rename_timeout` is applied as with
+        log_changes()
+        """
+
+        shas = list(shas)
+        if not (self.__rename_timeout > 0):
+            return self.__diff_tree_many(shas, workers)
+
+        rev_dict = self.get_commits()
+        return self.__capped_changes(shas,
+                                     lambda shas, stalled: self.__diff_tree_many(shas, workers, stalled),
+                                     lambda sha: (sha, self.__diff_commit_parents(sha, rev_dict[sha][1])))
+
+    def __diff_tree_many(self, shas, workers, stalled=None):
+        "diff_tree_many() backend; stops early setting `stalled` if git gets stuck (see __capped_changes())"
+
+        if not shas:
+            return
+
+        rev_dict = self.get_commits()
+        combined = self.__combined_merge_changes
+
+        def job(sha):
+            "(sha, parents to pair diff blocks with, lines to feed)"
+            parents = rev_dict[sha][1]
+            if combined and len(parents) > 1:
+                return sha, parents[:1], '%s\n' % sha # one combined diff
+            if parents:
+                return sha, parents, ''.join('%s %s\n' % (sha, parent) for parent in parents)
+            return sha, parents, '%s\n' % sha
+
+        workers = max(1, min(workers, len(shas)))
+        jobs = [ [ job(sha) for sha in shas[i::workers] ]
+                 for i in range(workers) ]
+        cancelled = []
+        ts0 = time.time()
+        nbytes = [ [0] for _ in jobs ] # per worker
+
+        def feed(p, jobs):
+            try:
+                for _, _, lines in jobs:
+                    p.stdin.write(lines)
+            except IOError:
+                pass # worker gone; noticed by collect()
+            finally:
+                try:
+                    p.stdin.close()
+                except IOError:
+                    pass
+
+        def put(queue, item):
+            while not cancelled:
+                try:
+                    queue.put(item, timeout=1)
+                    return
+                except Full:
+                    pass
+
+        def collect(p, jobs, queue, nbytes, watchdog):
+            try:
+                blocks = self.__raw_diff_blocks(p.stdout, nbytes, watchdog)
+                for sha, parents, _ in jobs:
+                    parent_changes = []
+                    for parent in parents or (None,):
+                        header, changes = blocks.next()
+                        if header != sha:
+                            raise GitError("unexpected diff-tree output for %s" % sha)
+                        parent_changes.append((parent, changes))
+                    put(queue, (sha, parent_changes))
+            except Exception, e:
+                if watchdog is not None and watchdog.fired:
+                    put(queue, None) # stalled
+                else:
+                    put(queue, GitError("diff-tree --stdin failed: %s" % e))
+
+        pool = []
+        watchdogs = []
+        try:
+            for worker_jobs, worker_nbytes in zip(jobs, nbytes):
+                p = self.repo.diff_tree_pipe('--stdin', '-z', '-r', '--root',
+                                             '--always', '--no-abbrev',
+                                             *(self.__rename_args() + (combined and ['-c'] or [])))
+                queue = Queue(maxsize=100)
+                pool.append((p, queue))
+                watchdog = None
+                if stalled is not None:
+                    watchdog = _StallWatchdog(p, self.__rename_timeout)
+                    watchdogs.append(watchdog)
+                for target, args in [(feed, (p, worker_jobs)),
+                                     (collect, (p, worker_jobs, queue, worker_nbytes, watchdog))]:
+                    t = Thread(target=target, args=args, name="PyGIT diff-tree")
+                    t.setDaemon(True)
+                    t.start()
+
+            for i in range(len(shas)):
+                item = pool[i % workers][1].get()
+                if item is None:
+                    stalled.append(True)
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        finally:
+            cancelled.append(True)
+            for watchdog in watchdogs:
+                watchdog.stop()
+            for p, _ in pool:
+                if p.poll() is None:
+                    p.terminate()
+                p.wait()
+            self.repo.record('diff-tree --stdin', time.time() - ts0, sum(n for n, in nbytes), None,
+                             ('(%d workers)' % workers,))
+
 ############################################################################
 ############################################################################
 ############################################################################
@@ -0,0 +1,183 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+"""
+Inverted index over commit messages, authors and commit ids, stored in
+an sqlite database file
+"""
+
+import re, zlib
+
+try:
+    import sqlite3 as sqlite
+except ImportError: # Python 2.4
+    from pysqlite2 import dbapi2 as sqlite
+
+__all__ = ['CommitIndex', 'tokenize']
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    "returns set of lowercased words (of at least 2 characters) in `text`"
+    return set(w for w in _WORD_RE.findall(text.lower()) if len(w) > 1)
+
+class CommitIndex(object):
+    """
+    Maps words of commit messages and authors as well as commit ids to
+    the commits containing them
+
+    Commits are numbered in the order they were added; besides the
+    postings, the time, author and (compressed) message of each commit
+    are stored, so that queries are answered without touching the
+    repository.  Query words match indexed words by prefix, and all
+    words of a query must match.
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS commits (id INTEGER PRIMARY KEY, rev TEXT UNIQUE,"
+        " time INTEGER, author TEXT, message BLOB)",
+        "CREATE TABLE IF NOT EXISTS postings (term TEXT, id INTEGER, PRIMARY KEY (term, id))",
+        ]
+
+    BATCH = 1000 # commits per transaction
+
+    def __init__(self, path):
+        self.path = path
+
+    def __connect(self):
+        cnx = sqlite.connect(self.path, timeout=30)
+        cnx.text_factory = unicode
+        for sql in self.SCHEMA:
+            cnx.execute(sql)
+        return cnx
+
+    def get_meta(self, name):
+        cnx = self.__connect()
+        try:
+            row = cnx.execute("SELECT value FROM meta WHERE name=?", (name,)).fetchone()
+            return row and row[0]
+        finally:
+            cnx.close()
+
+    def set_meta(self, name, value):
+        cnx = self.__connect()
+        try:
+            cnx.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+            cnx.commit()
+        finally:
+            cnx.close()
+
+    def get_indexed(self, revs):
+        "returns set of those commit ids of `revs` which are indexed"
+
+        revs = list(revs)
+        result = set()
+        cnx = self.__connect()
+        try:
+            for i in range(0, len(revs), 500): # stay below SQLite's limit of host parameters
+                chunk = revs[i:i+500]
+                result.update(str(rev) for rev, in
+                              cnx.execute("SELECT rev FROM commits WHERE rev IN (%s)"
+                                          % ','.join(['?'] * len(chunk)), chunk))
+        finally:
+            cnx.close()
+        return result
+
+    def clear(self):
+        cnx = self.__connect()
+        try:
+            for table in ('meta', 'commits', 'postings'):
+                cnx.execute("DELETE FROM %s" % table)
+            cnx.commit()
+        finally:
+            cnx.close()
+
+    def add(self, commits):
+        """
+        indexes the (rev, time, author, message, keywords) tuples of
+        `commits`, where `keywords` is additional text to be indexed
+        (but not stored), skipping already indexed commits
+
+        returns number of added commits
+        """
+
+        cnx = self.__connect()
+        added = 0
+        try:
+            cursor = cnx.cursor()
+            batch = 0
+            for rev, time, author, message, keywords in commits:
+                cursor.execute("INSERT OR IGNORE INTO commits (rev, time, author, message)"
+                               " VALUES (?, ?, ?, ?)",
+                               (rev, time, author,
+                                sqlite.Binary(zlib.compress(message.encode('utf-8')))))
+                if not cursor.rowcount:
+                    continue # indexed by someone else in the meantime
+
+                id = cursor.lastrowid
+                terms = tokenize(message) | tokenize(author) | tokenize(keywords)
+                terms.add(rev.lower())
+                cursor.executemany("INSERT OR IGNORE INTO postings (term, id) VALUES (?, ?)",
+                                   [ (term, id) for term in terms ])
+                added += 1
+
+                batch += 1
+                if batch >= self.BATCH:
+                    cnx.commit()
+                    batch = 0
+
+            cnx.commit()
+        finally:
+            cnx.close()
+
+        return added
+
+    def get_commits(self, revs):
+        """
+        returns list of (rev, time, author, message) tuples of those
+        commits of `revs` which are indexed, newest first
+        """
+
+        revs = list(revs)
+        result = []
+        cnx = self.__connect()
+        try:
+            for i in range(0, len(revs), 500): # stay below SQLite's limit of host parameters
+                chunk = revs[i:i+500]
+                result.extend(cnx.execute("SELECT rev, time, author, message FROM commits"
+                                          " WHERE rev IN (%s)" % ','.join(['?'] * len(chunk)),
+                                          chunk))
+        finally:
+            cnx.close()
+
+        result.sort(key=lambda row: row[1], reverse=True)
+        return [ (str(rev), time, author, zlib.decompress(str(message)).decode('utf-8'))
+                 for rev, time, author, message in result ]
+
+    def search(self, words):
+        """
+        returns list of (rev, time, author, message) tuples of the
+        commits matching all `words` (by prefix), newest first
+        """
+
+        words = set(w.lower() for w in words)
+        if not words:
+            return []
+
+        sql = ["SELECT rev, time, author, message FROM commits WHERE 1=1"]
+        args = []
+        for w in words:
+            sql.append(" AND id IN (SELECT id FROM postings WHERE term >= ? AND term < ?)")
+            args.extend([w, w + u'\uffff'])
+        sql.append(" ORDER BY time DESC")
+
+        cnx = self.__connect()
+        try:
+            return [ (str(rev), time, author, zlib.decompress(str(message)).decode('utf-8'))
+                     for rev, time, author, message in cnx.execute(''.join(sql), args) ]
+        finally:
+            cnx.close()
@@ -5,28 +5,44 @@
 # See COPYING for distribution information
 
 from trac.core import *
-from trac.util import TracError, shorten_line
-from trac.util.datefmt import FixedOffset, to_timestamp, format_datetime
+from trac.util import TracError, shorten_line, content_disposition
+from trac.util.datefmt import to_timestamp, to_utimestamp, from_utimestamp, format_datetime
 from trac.util.text import to_unicode
 from trac.versioncontrol.api import \
      Changeset, Node, Repository, IRepositoryConnector, NoSuchChangeset, NoSuchNode, \
-     IRepositoryProvider
+     IRepositoryProvider, RepositoryManager
 from trac.wiki import IWikiSyntaxProvider
-from trac.versioncontrol.cache import CachedRepository, CachedChangeset
+from trac.versioncontrol.cache import CachedRepository, CachedChangeset, \
+     CACHE_METADATA_KEYS, CACHE_YOUNGEST_REV, _inverted_kindmap, _inverted_actionmap
 from trac.versioncontrol.web_ui import IPropertyRenderer
-from trac.config import BoolOption, IntOption, PathOption, Option
-from trac.web.chrome import Chrome
+from trac.versioncontrol.web_ui.browser import BrowserModule
+from trac.mimeview.api import Mimeview, get_mimetype, MIME_MAP
+from trac.resource import ResourceNotFound
+from trac.search import ISearchSource, shorten_result
+from trac.admin import IAdminCommandProvider, AdminCommandError
+from trac.config import BoolOption, IntOption, ListOption, PathOption, Option
+from trac.web.api import IRequestFilter, IRequestHandler, RequestDone
+from trac.web.chrome import Chrome, add_link
 
 from genshi.builder import tag
 
-from datetime import datetime
+from fnmatch import fnmatchcase
+from itertools import izip
+from threading import Lock, Thread
+from Queue import Queue, Empty
 import sys
 import os
+import re
+import tempfile
+import time
+import urllib
+import weakref
 
 if not sys.version_info[:2] >= (2, 5):
     raise TracError("Python >= 2.5 dependancy not met")
 
 import PyGIT
+import commitindex
 
 
 class GitCachedRepository(CachedRepository):
@@ -34,8 +50,157 @@ class GitCachedRepository(CachedRepository):
     Git-specific cached repository
 
     Passes through {display,short,normalize}_rev
+
+    When more than `bulk_sync_threshold` commits are missing from the
+    cache, they're imported in batches from a single `git log` stream
+    instead of one changeset at a time; with `bulk_sync_workers` > 1,
+    their change lists are computed by that many concurrent
+    `git diff-tree` processes.
     """
 
+    BULK_SYNC_BATCH = 1000 # commits per transaction
+
+    def __init__(self, env, repos, log, bulk_sync_threshold=0, bulk_sync_workers=1):
+        CachedRepository.__init__(self, env, repos, log)
+        self._bulk_sync_threshold = bulk_sync_threshold
+        self._bulk_sync_workers = bulk_sync_workers
+
+    def sync(self, feedback=None, clean=False):
+        if self._bulk_sync_threshold <= 0:
+            return CachedRepository.sync(self, feedback, clean)
+
+        if clean:
+            self.log.info('Cleaning cache')
+            @self.env.with_transaction()
+            def do_clean(db):
+                cursor = db.cursor()
+                cursor.execute("DELETE FROM revision WHERE repos=%s",
+                               (self.id,))
+                cursor.execute("DELETE FROM node_change WHERE repos=%s",
+                               (self.id,))
+                cursor.executemany("""
+                    DELETE FROM repository WHERE id=%s AND name=%s
+                    """, [(self.id, k) for k in CACHE_METADATA_KEYS])
+                cursor.executemany("""
+                    INSERT INTO repository (id,name,value) VALUES (%s,%s,%s)
+                    """, [(self.id, k, '') for k in CACHE_METADATA_KEYS])
+                del self.metadata
+
+        self.repos.clear()
+        if clean or self._count_missing_estimate() >= self._bulk_sync_threshold:
+            self._bulk_sync(feedback)
+
+        # takes care of the remaining metadata and of concurrent changes
+        return CachedRepository.sync(self, feedback)
+
+    def _count_missing_estimate(self):
+        "estimates the number of commits not cached yet"
+
+        rev_dict = self.repos.git.get_commits()
+        youngest = self.metadata.get(CACHE_YOUNGEST_REV)
+        if youngest not in rev_dict:
+            return len(rev_dict)
+
+        # number of commits preceding the cached youngest one in topological order
+        return rev_dict[youngest][2] - 1
+
+    def _bulk_sync(self, feedback):
+        git = self.repos.git
+        rev_dict = git.get_rev_cache(fresh=True).rev_dict
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT rev FROM revision WHERE repos=%s", (self.id,))
+        cached = set(rev for rev, in cursor)
+
+        missing = [ rev for rev in rev_dict if rev not in cached ]
+        if not missing:
+            return
+
+        self.log.info("bulk import of %d commits into cache" % len(missing))
+        ts0 = time.time()
+
+        if self._bulk_sync_workers > 1:
+            # oldest first, i.e. in topological order
+            missing.sort(key=lambda rev: rev_dict[rev][2], reverse=True)
+            def merged():
+                for (commit, _), (sha, parent_changes) in \
+                        izip(git.log_changes(missing, with_changes=False),
+                             git.diff_tree_many(missing, self._bulk_sync_workers)):
+                    assert commit.sha == sha
+                    yield commit, parent_changes
+            changesets = merged()
+        elif len(missing) > len(cached):
+            # walking all commits is cheaper than looking up most of them
+            changesets = git.log_changes()
+        else:
+            missing.sort(key=lambda rev: rev_dict[rev][2], reverse=True)
+            changesets = git.log_changes(missing)
+
+        batch = []
+        for commit, parent_changes in changesets:
+            if commit.sha in cached:
+                continue
+            batch.append((commit, list(_get_changes(parent_changes))))
+            if len(batch) >= self.BULK_SYNC_BATCH:
+                if not self._insert_changesets(batch, feedback):
+                    return
+                batch = []
+
+        if batch and not self._insert_changesets(batch, feedback):
+            return
+
+        youngest = self.repos.get_youngest_rev()
+        @self.env.with_transaction()
+        def do_update(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                DELETE FROM repository WHERE id=%s AND name=%s
+                """, (self.id, CACHE_YOUNGEST_REV))
+            cursor.execute("""
+                INSERT INTO repository (id,name,value) VALUES (%s,%s,%s)
+                """, (self.id, CACHE_YOUNGEST_REV, youngest))
+            del self.metadata
+
+        self.log.info("bulk import of %d commits took %.1f s" % (len(missing), time.time()-ts0))
+
+    def _insert_changesets(self, batch, feedback):
+        "inserts list of (commit, changes) tuples within one transaction"
+
+        revisions = []
+        node_changes = []
+        for commit, changes in batch:
+            author, date = self.repos.get_commit_owner(commit)
+            revisions.append((self.id, self.db_rev(commit.sha), to_utimestamp(date),
+                              author, commit.message))
+            for path, kind, action, bpath, brev in changes:
+                node_changes.append((self.id, self.db_rev(commit.sha), path,
+                                     _inverted_kindmap[kind], _inverted_actionmap[action],
+                                     bpath, brev))
+
+        try:
+            @self.env.with_transaction()
+            def do_insert(db):
+                cursor = db.cursor()
+                cursor.executemany("""
+                    INSERT INTO revision (repos,rev,time,author,message)
+                    VALUES (%s,%s,%s,%s,%s)
+                    """, revisions)
+                cursor.executemany("""
+                    INSERT INTO node_change
+                        (repos,rev,path,node_type,change_type,base_path,base_rev)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s)
+                    """, node_changes)
+        except Exception, e: # a concurrent sync got there first
+            self.log.warning("bulk import into cache aborted: %r" % e)
+            return False
+
+        if feedback:
+            for commit, _ in batch:
+                feedback(commit.sha)
+
+        return True
+
     def display_rev(self, rev):
         return self.short_rev(rev)
 
@@ -53,6 +218,9 @@ class GitCachedRepository(CachedRepository):
     def get_changeset(self, rev):
         return GitCachedChangeset(self, self.normalize_rev(rev), self.env)
 
+    def get_changeset_titles(self, revs):
+        return self.repos.get_changeset_titles(revs)
+
 
 class GitCachedChangeset(CachedChangeset):
     """
@@ -76,6 +244,38 @@ def _last_iterable(iterable):
         v = nextv
     yield True, v
 
+def _get_changes(parent_changes):
+    """
+    turns (parent, diff_tree() tuples) pairs into the
+    (path, kind, change, base_path, base_rev) tuples
+    expected from Changeset.get_changes()
+    """
+
+    paths_seen = set()
+    for parent, changes in parent_changes:
+        for mode1, mode2, obj1, obj2, action, path1, path2 in changes:
+            path = path2 or path1
+            p_path, p_rev = path1, parent
+
+            kind = Node.FILE
+            if mode2.startswith('04') or mode1.startswith('04'):
+                kind = Node.DIRECTORY
+
+            action = GitChangeset.action_map[action[0]]
+
+            if action == Changeset.ADD:
+                p_path = ''
+                p_rev = None
+
+            # CachedRepository expects unique (rev, path, change_type) key
+            # this is only an issue in case of merges where files required editing
+            if path in paths_seen:
+                continue
+
+            paths_seen.add(path)
+
+            yield path, kind, action, p_path, p_rev
+
 def intersperse(sep, iterable):
     """
     The 'intersperse' generator takes an element and an iterable and
@@ -88,23 +288,17 @@ def intersperse(sep, iterable):
         if i: yield sep
         yield item
 
-# helper
-def _parse_user_time(s):
-    """
-    parse author/committer attribute lines and return
-    (user,timestamp)
-    """
-
-    user, time, tz_str = s.rsplit(None, 2)
-    tz = FixedOffset((int(tz_str)*6)/10, tz_str)
-    time = datetime.fromtimestamp(float(time), tz)
-    return user, time
-
 class GitConnector(Component):
-    implements(IRepositoryConnector, IWikiSyntaxProvider)
+    implements(IRepositoryConnector, IWikiSyntaxProvider, IRequestFilter)
 
     def __init__(self):
         self._version = None
+        self._prefetched = weakref.WeakKeyDictionary() # formatter -> set(reponame)
+        self._user_map = (None, 0) # (email -> uid dict, expiry time)
+        self._storages = weakref.WeakValueDictionary() # reponame -> PyGIT.Storage
+
+        if self._slow_command_threshold > 0:
+            PyGIT.command_stats.slow_threshold = self._slow_command_threshold / 1000.0
 
         try:
             self._version = PyGIT.Storage.git_version(git_bin=self._git_bin)
@@ -134,20 +328,61 @@ class GitConnector(Component):
             context = context.parent
 
         try:
+            # reject hex words which aren't commits without touching the repository
+            git = self._storages.get(reponame)
+            if git is not None and git.has_rev(sha) is False:
+                raise NoSuchChangeset(sha)
+
             repos = self.env.get_repository(reponame)
 
             if not repos:
                 raise Exception("Repository '%s' not found" % reponame)
 
             sha = repos.normalize_rev(sha) # in case it was abbreviated
-            changeset = repos.get_changeset(sha)
+
+            if hasattr(repos, 'get_changeset_titles'):
+                self._prefetch_sha_titles(formatter, reponame, repos)
+                title = repos.get_changeset_titles([sha]).get(sha)
+                if title is None:
+                    raise NoSuchChangeset(sha)
+            else: # not a git repository
+                title = repos.get_changeset(sha).message
+
             return tag.a(label, class_="changeset",
-                         title=shorten_line(changeset.message),
+                         title=shorten_line(title),
                          href=formatter.href.changeset(sha, repos.reponame))
         except Exception, e:
             return tag.a(label, class_="missing changeset",
                          title=to_unicode(e), rel="nofollow")
 
+    def _prefetch_sha_titles(self, formatter, reponame, repos):
+        """
+        resolve the titles of all sha ids found in the wiki text being
+        rendered by `formatter` with a single (pipelined) lookup
+        """
+
+        source = getattr(formatter, 'source', None)
+        if not source:
+            return
+
+        prefetched = self._prefetched.setdefault(formatter, set())
+        if reponame in prefetched:
+            return
+        prefetched.add(reponame)
+
+        pat = re.compile(r'\br?([0-9a-fA-F]{%d,40})\b' % self._wiki_shortrev_len)
+
+        git = (isinstance(repos, GitCachedRepository) and repos.repos or repos).git
+
+        shas = []
+        for srev in set(pat.findall(source)):
+            sha = git.fullrev(srev)
+            if sha:
+                shas.append(sha)
+
+        if shas:
+            repos.get_changeset_titles(shas)
+
     def get_wiki_syntax(self):
         yield (r'(?:\b|!)r?[0-9a-fA-F]{%d,40}\b' % self._wiki_shortrev_len,
                lambda fmt, sha, match: self._format_sha_link(fmt, sha.startswith('r') and sha[1:] or sha, sha))
@@ -155,15 +390,89 @@ class GitConnector(Component):
     def get_link_resolvers(self):
         yield 'sha', lambda fmt, _, sha, label, match=None: self._format_sha_link(fmt, sha, label)
 
+    #######################
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        # email addresses may have been changed
+        if req.method == 'POST' and req.path_info.startswith('/prefs'):
+            self._user_map = (None, 0)
+        return template, data, content_type
+
     #######################
     # IRepositoryConnector
 
     _persistent_cache = BoolOption('git', 'persistent_cache', 'false',
                                    "enable persistent caching of commit tree")
 
+    _storage_pool_size = IntOption('git', 'storage_pool_size', 0,
+                                   "maximum number of repositories whose caches are kept"
+                                   " across requests, least recently used ones are dropped"
+                                   " first (0 means no limit if `persistent_cache` is enabled,"
+                                   " and no pooling otherwise); the pool is shared by all"
+                                   " environments of a process, which get the most generous"
+                                   " of their `storage_pool_*` budgets")
+
+    _storage_pool_memory = IntOption('git', 'storage_pool_memory', 0,
+                                     "approximate number of megabytes the caches of pooled"
+                                     " repositories may take up (0 means no limit)")
+
+    _idle_pipe_timeout = IntOption('git', 'idle_pipe_timeout', 0,
+                                   "number of seconds after which unused `git cat-file`"
+                                   " processes are shut down (0 keeps them running)")
+
     _cached_repository = BoolOption('git', 'cached_repository', 'false',
                                     "wrap `GitRepository` in `CachedRepository`")
 
+    _bulk_sync_threshold = IntOption('git', 'bulk_sync_threshold', 100,
+                                     "number of uncached commits from which on `cached_repository`"
+                                     " imports them in bulk from a single `git log` run"
+                                     " (0 disables bulk imports)")
+
+    _bulk_sync_workers = IntOption('git', 'bulk_sync_workers', 1,
+                                   "number of concurrent `git diff-tree` processes computing"
+                                   " change lists during bulk imports (1 takes them from"
+                                   " the `git log` stream)")
+
+    _rev_cache_max_staleness = IntOption('git', 'rev_cache_max_staleness', 0,
+                                         "number of seconds an outdated commit tree cache keeps"
+                                         " being used while an updated one is built in the"
+                                         " background (0 makes requests wait for the rebuild)")
+
+    _changes_cache_dir = PathOption('git', 'changes_cache_dir', '',
+                                    "folder for persisting the change lists of commits"
+                                    " (relative to trac project folder; disabled if empty)")
+
+    _ref_filter = ListOption('git', 'ref_filter', '',
+                             doc="glob patterns of the refs (e.g. `refs/heads/*`) whose commits,"
+                             " branches and tags are shown; patterns prefixed with `!` exclude"
+                             " refs (all refs are shown if empty; can be overridden per"
+                             " repository with a `ref_filter` repository option)")
+
+    _trace_file = PathOption('git', 'trace_file', '',
+                             "file to append a record of every call of the git storage API"
+                             " to, for replaying with `python -m tracext.git.replay`"
+                             " (relative to trac project folder; disabled if empty)")
+
+    _combined_merge_changes = BoolOption('git', 'combined_merge_changes', 'false',
+                                         "list only the paths of merge changesets which differ"
+                                         " from all parents (as `git diff-tree -c` does), computed"
+                                         " in a single pass against the first parent, instead of"
+                                         " diffing against each parent")
+
+    _rename_limit = IntOption('git', 'rename_limit', 0,
+                              "number of added/deleted files above which only exact renames"
+                              " are detected (like git's `diff.renameLimit`; 0 uses git's default)")
+
+    _rename_timeout = IntOption('git', 'rename_timeout', 0,
+                                "number of seconds after which rename detection for a changeset"
+                                " is given up and its renames are shown as additions and deletions;"
+                                " the outcome is remembered per changeset in the environment's"
+                                " `git-renames` folder (0 disables the limit)")
+
     _shortrev_len = IntOption('git', 'shortrev_len', 7,
                               "length rev sha sums should be tried to be abbreviated to"
                               " (must be >= 4 and <= 40)")
@@ -175,6 +484,11 @@ class GitConnector(Component):
     _trac_user_rlookup = BoolOption('git', 'trac_user_rlookup', 'false',
                                     "enable reverse mapping of git email addresses to trac user ids")
 
+    _trac_user_rlookup_ttl = IntOption('git', 'trac_user_rlookup_ttl', 300,
+                                       "number of seconds the mapping of email addresses to trac"
+                                       " user ids is cached (it's also refreshed whenever"
+                                       " user preferences are saved)")
+
     _use_committer_id = BoolOption('git', 'use_committer_id', 'true',
                                    "use git-committer id instead of git-author id as changeset owner")
 
@@ -188,6 +502,10 @@ class GitConnector(Component):
     _git_bin = PathOption('git', 'git_bin', '/usr/bin/git',
                           "path to git executable (relative to trac project folder!)")
 
+    _slow_command_threshold = IntOption('git', 'slow_command_threshold', 0,
+                                        "log git invocations taking longer than this many"
+                                        " milliseconds as warnings (0 disables)")
+
 
     def get_supported_types(self):
         yield ("git", 8)
@@ -223,17 +541,16 @@ class GitConnector(Component):
                 except Exception:
                     return None
 
-                for _uid, _name, _email in self.env.get_known_users():
-                    try:
-                        if email == _email.lower():
-                            return _uid
-                    except Exception:
-                        continue
+                return self._get_user_map().get(email)
 
         else:
             def rlookup_uid(_):
                 return None
 
+        ref_filter = self._ref_filter
+        if params.get('ref_filter') is not None:
+            ref_filter = [ p.strip() for p in params['ref_filter'].split(',') if p.strip() ]
+
         repos = GitRepository(dir, params, self.log,
                               persistent_cache=self._persistent_cache,
                               git_bin=self._git_bin,
@@ -242,10 +559,27 @@ class GitConnector(Component):
                               rlookup_uid=rlookup_uid,
                               use_committer_id=self._use_committer_id,
                               use_committer_time=self._use_committer_time,
+                              rev_cache_max_staleness=self._rev_cache_max_staleness,
+                              changes_cache_dir=self._changes_cache_dir or None,
+                              ref_filter=ref_filter,
+                              trace_file=self._trace_file or None,
+                              combined_merge_changes=self._combined_merge_changes,
+                              rename_limit=self._rename_limit,
+                              rename_timeout=self._rename_timeout,
+                              renames_file=os.path.join(self.env.path, 'git-renames', '%s.txt'
+                                                        % (urllib.quote(params.get('name', ''), '')
+                                                           or '(default)')),
+                              storage_pool_size=self._storage_pool_size,
+                              storage_pool_memory=self._storage_pool_memory * 1024 * 1024,
+                              idle_pipe_timeout=self._idle_pipe_timeout,
+                              mime_map=Mimeview(self.env).mime_map,
                               )
+        self._storages[params.get('name', '')] = repos.git
 
         if self._cached_repository:
-            repos = GitCachedRepository(self.env, repos, self.log)
+            repos = GitCachedRepository(self.env, repos, self.log,
+                                        bulk_sync_threshold=self._bulk_sync_threshold,
+                                        bulk_sync_workers=self._bulk_sync_workers)
             self.log.debug("enabled CachedRepository for '%s'" % dir)
         else:
             self.log.debug("disabled CachedRepository for '%s'" % dir)
@@ -253,6 +587,606 @@ class GitConnector(Component):
         return repos
 
 
+    def _keeps_storage(self):
+        "whether caches of repositories survive the end of requests"
+        return bool(self._persistent_cache or self._storage_pool_size > 0
+                    or self._storage_pool_memory > 0)
+
+    def _get_user_map(self):
+        "returns (cached) dict mapping lowercased email addresses to trac user ids"
+
+        user_map, expires = self._user_map
+        if user_map is None or time.time() >= expires:
+            user_map = {}
+            for _uid, _name, _email in self.env.get_known_users():
+                try:
+                    user_map.setdefault(_email.lower(), _uid)
+                except Exception:
+                    continue
+
+            self._user_map = (user_map, time.time() + self._trac_user_rlookup_ttl)
+
+        return user_map
+
+
+class GitCommandStatsLogger(Component):
+    """
+    Logs a per-request breakdown of git invocations
+
+    process-wide totals are available via `PyGIT.command_stats`
+    """
+
+    implements(IRequestFilter)
+
+    _log_request_stats = BoolOption('git', 'log_request_stats', 'false',
+                                    "log per-request statistics of git command invocations")
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        PyGIT.command_stats.begin_scope()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        stats = PyGIT.command_stats.end_scope()
+        if stats and self._log_request_stats:
+            self.log.info("git commands for %s: %s"
+                          % (req.path_info, PyGIT.GitCommandStats.format_stats(stats)))
+        return template, data, content_type
+
+
+class GitWarmup(Component):
+    """
+    Warms up revision caches of git repositories in the background
+
+    Triggered by the first request after startup; repositories are
+    processed most-recently-pushed first by a bounded pool of threads.
+    """
+
+    implements(IRequestFilter)
+
+    _warmup_threads = IntOption('git', 'warmup_threads', 0,
+                                "number of background threads building revision caches"
+                                " after startup (0 disables warm-up; requires `persistent_cache`"
+                                " or `storage_pool_size`)")
+
+    _warmup_repositories = ListOption('git', 'warmup_repositories', '',
+                                      doc="names of repositories to warm up"
+                                      " (all git repositories if empty)")
+
+    def __init__(self):
+        self._started = False
+        self._lock = Lock()
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        if not self._started and self._warmup_threads > 0:
+            with self._lock:
+                if not self._started:
+                    self._started = True
+                    self._start()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # internal methods
+
+    def _start(self):
+        if not GitConnector(self.env)._keeps_storage():
+            self.log.warning("git warm-up disabled (requires [git] persistent_cache"
+                             " or storage_pool_size)")
+            return
+
+        t = Thread(target=self._run, name="git-warmup")
+        t.setDaemon(True)
+        t.start()
+
+    def _get_repositories(self):
+        "returns list of (reponame, info) tuples, most recently pushed first"
+
+        rm = RepositoryManager(self.env)
+        names = set(self._warmup_repositories)
+
+        result = []
+        for reponame, info in rm.get_all_repositories().iteritems():
+            if 'alias' in info or not info.get('dir'):
+                continue
+            if (info.get('type') or rm.repository_type) != 'git':
+                continue
+            if names and reponame not in names:
+                continue
+            info = info.copy()
+            if not os.path.isabs(info['dir']): # as done by RepositoryManager.get_repository()
+                info['dir'] = os.path.join(self.env.path, info['dir'])
+            result.append((PyGIT.Storage.last_update_time(info['dir']), reponame, info))
+
+        result.sort(key=lambda e: e[0], reverse=True)
+
+        return [ (reponame, info) for _, reponame, info in result ]
+
+    def _run(self):
+        try:
+            repositories = self._get_repositories()
+        except Exception, e:
+            self.log.error("git warm-up failed: %s" % to_unicode(e))
+            return
+
+        self.log.info("starting warm-up of %d git repositories" % len(repositories))
+
+        queue = Queue()
+        for e in repositories:
+            queue.put(e)
+
+        for i in range(min(self._warmup_threads, len(repositories))):
+            t = Thread(target=self._worker, args=(queue,), name="git-warmup-%d" % i)
+            t.setDaemon(True)
+            t.start()
+
+    def _worker(self, queue):
+        connector = GitConnector(self.env)
+
+        while True:
+            try:
+                reponame, info = queue.get_nowait()
+            except Empty:
+                return
+
+            ts0 = time.time()
+            try:
+                repos = connector.get_repository('git', info['dir'], info)
+                if isinstance(repos, GitCachedRepository):
+                    repos.repos.git.warmup()
+                else:
+                    repos.git.warmup()
+                    if GitSearchModule(self.env)._search_index:
+                        GitSearchModule(self.env).update_index(repos)
+            except Exception, e:
+                self.log.warning("warm-up of git repository '%s' failed: %s"
+                                 % (reponame, to_unicode(e)))
+                continue
+
+            self.log.debug("warmed up git repository '%s' (took %.1f ms)"
+                           % (reponame, 1000*(time.time()-ts0)))
+
+
+class GitPushNotifier(Component):
+    """
+    Pre-warms caches of running web processes after a push
+
+    `trac-admin $ENV git notify <repos> [rev] [...]` (to be called from
+    a post-receive hook) records the notification in a file below the
+    environment's `git-notify` folder; every web process polls these
+    files and then refreshes its revision cache, reads the commit records
+    and change lists of the new commits and syncs `cached_repository`.
+    """
+
+    implements(IAdminCommandProvider, IRequestFilter)
+
+    _notify_poll_interval = IntOption('git', 'notify_poll_interval', 0,
+                                      "number of seconds between checks for notifications"
+                                      " from `trac-admin git notify` (0 disables polling;"
+                                      " requires `persistent_cache` or `storage_pool_size`)")
+
+    _notify_diff_workers = IntOption('git', 'notify_diff_workers', 1,
+                                     "number of concurrent `git diff-tree` processes"
+                                     " computing change lists of pushed commits")
+
+    NOTIFY_DIR = 'git-notify'
+    NOTIFY_MAX_SIZE = 0x10000 # notification files are truncated when growing larger
+
+    def __init__(self):
+        self._started = False
+        self._lock = Lock()
+
+    # IAdminCommandProvider
+
+    def get_admin_commands(self):
+        yield ('git notify', '<repos> [rev] [...]',
+               """Notify web processes about commits pushed to a git repository
+
+               This command should be called from a post-receive hook, e.g.
+               with the output of `git rev-list <oldrev>..<newrev>`; new
+               commits are also detected without being passed.
+               """,
+               self._complete_repos, self._do_notify)
+
+    def _complete_repos(self, args):
+        if len(args) == 1:
+            return [ reponame or '(default)' for reponame in
+                     RepositoryManager(self.env).get_all_repositories() ]
+
+    def _do_notify(self, reponame, *revs):
+        if reponame == '(default)':
+            reponame = ''
+        if not RepositoryManager(self.env).get_repository(reponame):
+            raise AdminCommandError("Repository '%s' not found" % (reponame or '(default)'))
+
+        notify_dir = os.path.join(self.env.path, self.NOTIFY_DIR)
+        if not os.path.isdir(notify_dir):
+            os.mkdir(notify_dir)
+
+        path = self._get_notify_path(reponame)
+        mode = 'a'
+        if os.path.exists(path) and os.path.getsize(path) > self.NOTIFY_MAX_SIZE:
+            mode = 'w' # pollers start over from the beginning
+        f = open(path, mode)
+        try:
+            f.write(''.join('%s\n' % rev for rev in revs))
+        finally:
+            f.close()
+        os.utime(path, None)
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        if not self._started and self._notify_poll_interval > 0:
+            with self._lock:
+                if not self._started:
+                    self._started = True
+                    self._start()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # internal methods
+
+    def _get_notify_path(self, reponame):
+        return os.path.join(self.env.path, self.NOTIFY_DIR,
+                            urllib.quote(reponame, '') or '(default)')
+
+    def _start(self):
+        if not GitConnector(self.env)._keeps_storage():
+            self.log.warning("git push notifications disabled (requires [git] persistent_cache"
+                             " or storage_pool_size)")
+            return
+
+        t = Thread(target=self._poll, name="git-notify")
+        t.setDaemon(True)
+        t.start()
+
+    def _poll(self):
+        notify_dir = os.path.join(self.env.path, self.NOTIFY_DIR)
+        offsets = {} # file name -> (mtime, offset of first unread byte)
+
+        # only notifications received from now on are of interest
+        for fname in os.path.isdir(notify_dir) and os.listdir(notify_dir) or []:
+            st = os.stat(os.path.join(notify_dir, fname))
+            offsets[fname] = (st.st_mtime, st.st_size)
+
+        while True:
+            time.sleep(self._notify_poll_interval)
+
+            try:
+                fnames = os.listdir(notify_dir)
+            except OSError:
+                continue
+
+            for fname in fnames:
+                path = os.path.join(notify_dir, fname)
+                try:
+                    st = os.stat(path)
+                    mtime, offset = offsets.get(fname, (None, 0))
+                    if st.st_mtime == mtime and st.st_size == offset:
+                        continue
+                    if st.st_size < offset: # truncated by _do_notify()
+                        offset = 0
+
+                    f = open(path)
+                    try:
+                        f.seek(offset)
+                        data = f.read()
+                    finally:
+                        f.close()
+                    # ignore partially written last line
+                    data = data[:data.rfind('\n') + 1]
+                    offsets[fname] = (st.st_mtime, offset + len(data))
+
+                    reponame = urllib.unquote(fname)
+                    if reponame == '(default)':
+                        reponame = ''
+                    self._process(reponame, data.split())
+                except Exception, e:
+                    self.log.warning("processing git push notification '%s' failed: %s"
+                                     % (fname, to_unicode(e)))
+
+    def _process(self, reponame, revs):
+        ts0 = time.time()
+
+        repos = RepositoryManager(self.env).get_repository(reponame)
+        git_repos = isinstance(repos, GitCachedRepository) and repos.repos or repos
+        if not isinstance(git_repos, GitRepository):
+            return
+
+        git = git_repos.git
+        known = set(git.all_revs())
+
+        git.sync()
+        rev_dict = git.get_rev_cache(fresh=True).rev_dict
+
+        shas = set(rev for rev in rev_dict if rev not in known)
+        for rev in revs:
+            sha = git.verifyrev(rev)
+            if sha:
+                shas.add(sha)
+
+        # oldest first, i.e. in topological order
+        shas = sorted(shas, key=lambda sha: rev_dict[sha][2], reverse=True)
+        git.warmup_commits(shas, self._notify_diff_workers)
+
+        if isinstance(repos, CachedRepository):
+            repos.sync()
+        elif GitSearchModule(self.env)._search_index:
+            GitSearchModule(self.env).update_index(repos)
+
+        self.log.info("pre-warmed caches for %d commits pushed to '%s' (took %.1f ms)"
+                      % (len(shas), reponame or '(default)', 1000*(time.time()-ts0)))
+
+
+class GitSearchModule(Component):
+    """
+    Searches commit messages, authors and ids of git repositories
+
+    Each repository has an inverted index (see `commitindex`) in the
+    environment's `git-search` folder.  Push notifications and the
+    background warm-up bring it up to date; a search indexes at most
+    `search_index_batch` of the missing commits (newest first) itself.
+    Terms of the form `author:<user>` or `committer:<user>`, where
+    `<user>` is an email address or a Trac user name, restrict the
+    results to that user's commits (as looked up in the revision cache's
+    user indices).  Repositories wrapped in `cached_repository` are left to Trac's own
+    changeset search, which still scans their `revision` table (Trac
+    provides no way to suppress its duplicate results).
+    """
+
+    implements(ISearchSource)
+
+    _search_index = BoolOption('git', 'search_index', 'true',
+                               "search the changesets of git repositories not using"
+                               " `cached_repository` through an inverted index of their"
+                               " commit messages, authors and ids")
+
+    _search_index_batch = IntOption('git', 'search_index_batch', 1000,
+                                    "maximum number of commits indexed while serving a search"
+                                    " request (the rest is indexed by later searches, push"
+                                    " notifications and warm-up; 0 means no limit)")
+
+    INDEX_DIR = 'git-search'
+
+    def __init__(self):
+        self._lock = Lock() # serializes index updates within the process
+
+    # ISearchSource
+
+    def get_search_filters(self, req):
+        return [] # results are listed under the changeset filter of ChangesetModule
+
+    def get_search_results(self, req, terms, filters):
+        if not self._search_index or 'changeset' not in filters:
+            return
+
+        words = set()
+        users = [] # (role, email)
+        for term in terms:
+            role, sep, user = term.partition(':')
+            if sep and user and role.lower() in ('author', 'committer'):
+                users.append((role.lower(), self._get_email(user)))
+            else:
+                words |= commitindex.tokenize(term)
+        if not words and not users:
+            return
+        terms = [ term for term in terms if term.partition(':')[0].lower()
+                  not in ('author', 'committer') ]
+
+        rm = RepositoryManager(self.env)
+        for repos in rm.get_real_repositories():
+            if not isinstance(repos, GitRepository):
+                continue # cached ones are searched by ChangesetModule
+
+            try:
+                index = self.update_index(repos, self._search_index_batch or None)
+            except Exception, e:
+                self.log.warning("updating search index of git repository '%s' failed: %s"
+                                 % (repos.reponame or '(default)', to_unicode(e)))
+                continue
+
+            rev_dict = repos.git.get_commits()
+            if users:
+                revs = set(repos.git.get_user_commits(users[0][1], role=users[0][0]))
+                for role, email in users[1:]:
+                    revs.intersection_update(repos.git.get_user_commits(email, role=role))
+                if words:
+                    results = [ r for r in index.search(words) if r[0] in revs ]
+                else:
+                    results = index.get_commits(revs)
+            else:
+                results = index.search(words)
+
+            for rev, ts, author, message in results:
+                if rev not in rev_dict:
+                    continue # no longer reachable
+                cset = repos.resource.child('changeset', rev)
+                if 'CHANGESET_VIEW' in req.perm(cset):
+                    yield (req.href.changeset(rev, repos.reponame or None),
+                           '[%s]: %s' % (repos.display_rev(rev), shorten_line(message)),
+                           from_utimestamp(ts), author, shorten_result(message, terms))
+
+    # internal methods
+
+    def _get_email(self, user):
+        "maps Trac user name `user` to its email address, if known"
+
+        if '@' not in user:
+            for uid, _, email in self.env.get_known_users():
+                if uid == user and email:
+                    return email
+        return user
+
+    def _get_index(self, repos):
+        index_dir = os.path.join(self.env.path, self.INDEX_DIR)
+        if not os.path.isdir(index_dir):
+            os.mkdir(index_dir)
+
+        return commitindex.CommitIndex(
+            os.path.join(index_dir, '%s.db' % (urllib.quote(repos.reponame, '') or '(default)')))
+
+    def update_index(self, repos, limit=None):
+        """
+        adds the commits of `repos` not indexed yet (at most `limit`
+        of them, newest first, if given); returns the CommitIndex
+        """
+
+        git_repos = isinstance(repos, GitCachedRepository) and repos.repos or repos
+        git = git_repos.git
+        index = self._get_index(repos)
+
+        heads = ' '.join(git.get_ref_heads())
+
+        with self._lock:
+            if index.get_meta('repos') != git_repos.gitrepo:
+                index.clear() # new index, or repository was moved or replaced
+                index.set_meta('repos', git_repos.gitrepo)
+
+            # the refs as of the last complete update
+            old_heads = index.get_meta('heads')
+            if old_heads == heads:
+                return index
+
+            # only the commits added since then (youngest first) need to be looked at
+            ts0 = time.time()
+            revs = git.revs_between((old_heads or '').split(), heads.split())
+            indexed = index.get_indexed(revs)
+            revs = [ rev for rev in revs if rev not in indexed ]
+
+            complete = limit is None or len(revs) <= limit
+            if not complete:
+                revs = revs[:limit]
+
+            def docs():
+                for commit, _ in git.log_changes(revs, with_changes=False):
+                    author, date = git_repos.get_commit_owner(commit)
+                    yield (commit.sha, to_utimestamp(date), author, commit.message,
+                           u'%s %s' % (commit.author, commit.committer))
+
+            added = revs and index.add(docs()) or 0
+            if complete:
+                index.set_meta('heads', heads)
+
+        if added:
+            self.log.debug("indexed %d commits of git repository '%s' (took %.1f ms)"
+                           % (added, repos.reponame or '(default)', 1000*(time.time()-ts0)))
+
+        return index
+
+
+class GitArchiveModule(Component):
+    """
+    Serves zip and tar.gz archives of git trees straight from `git archive`
+
+    Replaces the browser's "Zip Archive" link (which would otherwise
+    assemble the archive from the individual nodes) for git repositories.
+    """
+
+    implements(IRequestHandler, IRequestFilter)
+
+    MIMETYPES = {
+        'zip': 'application/zip',
+        'tar.gz': 'application/x-gzip',
+        }
+
+    CHUNK_SIZE = 64 * 1024
+
+    # IRequestHandler
+
+    def match_request(self, req):
+        match = re.match(r'/git-archive(/.*)?$', req.path_info)
+        if match:
+            req.args['path'] = match.group(1) or '/'
+            return True
+
+    def process_request(self, req):
+        format = req.args.get('format', 'zip')
+        if format not in self.MIMETYPES:
+            raise TracError("Unsupported archive format '%s'" % format)
+
+        reponame, repos, path = \
+            RepositoryManager(self.env).get_repository_by_path(req.args['path'])
+        git_repos = isinstance(repos, GitCachedRepository) and repos.repos or repos
+        if not isinstance(git_repos, GitRepository):
+            raise ResourceNotFound("No git repository for '%s'" % req.args['path'])
+
+        rev = repos.normalize_rev(req.args.get('rev'))
+        node = repos.get_node(path, rev)
+        req.perm(node.resource).require('BROWSER_VIEW')
+        req.perm(node.resource).require('FILE_VIEW')
+        if not node.isdir or not self._is_downloadable(repos, node.path):
+            raise TracError("Archives of '%s' are not available" % node.path)
+
+        rpath = node.path.strip('/')
+        name = '-'.join(filter(None, [reponame, rpath.replace('/', '_'),
+                                      repos.short_rev(rev)]))
+
+        # req.write() insists on a Content-Length, hence the archive is
+        # spooled to a temporary file (rather than memory) first
+        spool = tempfile.TemporaryFile(prefix='trac-git-archive-')
+        try:
+            for chunk in git_repos.git.archive(rev, rpath, format, prefix=name):
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+
+            req.send_response(200)
+            req.send_header('Content-Type', self.MIMETYPES[format])
+            req.send_header('Content-Disposition',
+                            content_disposition('attachment', '%s.%s' % (name, format)))
+            req.send_header('Content-Length', size)
+            req.end_headers()
+
+            if req.method != 'HEAD':
+                while True:
+                    chunk = spool.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    req.write(chunk)
+        finally:
+            spool.close()
+
+        raise RequestDone
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        if template == 'browser.html' and data and data.get('dir'):
+            repos = data.get('repos')
+            links = req.chrome.get('links', {}).get('alternate', [])
+            zip_links = [ link for link in links if link.get('type') == self.MIMETYPES['zip'] ]
+            if zip_links and isinstance(repos, (GitRepository, GitCachedRepository)):
+                path = '/'.join(filter(None, [repos.reponame, data['path'].strip('/')]))
+                rev = data.get('stickyrev') or repos.youngest_rev
+                for link in zip_links:
+                    link['href'] = req.href('git-archive', path, rev=rev, format='zip')
+                add_link(req, 'alternate', req.href('git-archive', path, rev=rev, format='tar.gz'),
+                         'Tar Archive (gzip)', self.MIMETYPES['tar.gz'], 'tgz')
+
+        return template, data, content_type
+
+    # internal methods
+
+    def _is_downloadable(self, repos, path):
+        "mirrors the browser's check of the `[browser] downloadable_paths` option"
+
+        path = path.strip('/')
+        if repos.reponame:
+            path = repos.reponame + '/' + path
+        return any(fnmatchcase(path, p.strip('/'))
+                   for p in BrowserModule(self.env).downloadable_paths)
+
+
 class CsetPropertyRenderer(Component):
     implements(IPropertyRenderer)
 
@@ -268,17 +1202,31 @@ class CsetPropertyRenderer(Component):
 
     def render_property(self, name, mode, context, props):
 
+        titles = {}
+        if name in ('Branches', 'Parents', 'Children'):
+            revs = props[name]
+            if name == 'Branches':
+                revs = [ rev for _, rev in revs ]
+
+            # resolve all titles at once
+            try:
+                repos = self.env.get_repository(context.resource.parent.id)
+                titles = repos.get_changeset_titles(revs)
+            except Exception:
+                pass
+
         def sha_link(sha, label=None):
             # sha is assumed to be a non-abbreviated 40-chars sha id
             try:
                 reponame = context.resource.parent.id
                 repos = self.env.get_repository(reponame)
-                cset = repos.get_changeset(sha)
+                if sha not in titles:
+                    raise NoSuchChangeset(sha)
                 if label is None:
                     label = repos.display_rev(sha)
 
                 return tag.a(label, class_="changeset",
-                             title=shorten_line(cset.message),
+                             title=shorten_line(titles[sha]),
                              href=context.href.changeset(sha, repos.reponame))
 
             except Exception, e:
@@ -345,9 +1293,22 @@ class GitRepository(Repository):
                  rlookup_uid=lambda _: None,
                  use_committer_id=False,
                  use_committer_time=False,
+                 rev_cache_max_staleness=0,
+                 changes_cache_dir=None,
+                 ref_filter=None,
+                 trace_file=None,
+                 combined_merge_changes=False,
+                 rename_limit=0,
+                 rename_timeout=0,
+                 renames_file=None,
+                 storage_pool_size=0,
+                 storage_pool_memory=0,
+                 idle_pipe_timeout=0,
+                 mime_map=MIME_MAP,
                  ):
 
         self.logger = log
+        self.mime_map = mime_map
         self.gitrepo = path
         self.params = params
         self._shortrev_len = max(4, min(shortrev_len, 40))
@@ -355,9 +1316,25 @@ class GitRepository(Repository):
         self._use_committer_time = use_committer_time
         self._use_committer_id = use_committer_id
 
-        self.git = PyGIT.StorageFactory(path, log, not persistent_cache,
+        # pooled Storage instances outlive the request
+        weak = not (persistent_cache or storage_pool_size > 0 or storage_pool_memory > 0)
+
+        self.git = PyGIT.StorageFactory(path, log, weak,
                                         git_bin=git_bin,
-                                        git_fs_encoding=git_fs_encoding).getInstance()
+                                        git_fs_encoding=git_fs_encoding,
+                                        rev_cache_max_staleness=rev_cache_max_staleness,
+                                        changes_cache_dir=changes_cache_dir,
+                                        ref_filter=ref_filter,
+                                        trace_file=trace_file,
+                                        combined_merge_changes=combined_merge_changes,
+                                        rename_limit=rename_limit,
+                                        rename_timeout=rename_timeout,
+                                        renames_file=renames_file,
+                                        use_committer_time=use_committer_time,
+                                        pool_size=storage_pool_size,
+                                        pool_memory=storage_pool_memory,
+                                        idle_pipe_timeout=idle_pipe_timeout,
+                                        ).getInstance()
 
         Repository.__init__(self, "git:"+path, self.params, log)
 
@@ -407,6 +1384,33 @@ class GitRepository(Repository):
         """GitChangeset factory method"""
         return GitChangeset(self, rev)
 
+    def get_changeset_titles(self, revs):
+        """
+        returns dict mapping (non-abbreviated) commit ids to the
+        beginning of their commit messages, suitable for link titles;
+        unknown commit ids are left out
+        """
+        return self.git.get_commit_titles(revs)
+
+    def get_commit_owner(self, commit):
+        "returns (author, date) to be used for the changeset of `commit`"
+
+        # use 1st author/committer as changeset owner/timestamp
+        if self._use_committer_time:
+            time_ = commit.committer_time
+        else:
+            time_ = commit.author_time
+
+        if self._use_committer_id:
+            user_ = commit.committer
+        else:
+            user_ = commit.author
+
+        # try to resolve email address to trac uid
+        user_ = self.rlookup_uid(user_) or user_
+
+        return user_, time_
+
     def get_changes(self, old_path, old_rev, new_path, new_rev, ignore_ancestry=0):
         # TODO: handle renames/copies, ignore_ancestry
         if old_path != new_path:
@@ -427,17 +1431,19 @@ class GitRepository(Repository):
                     new_node = None
 
                     if change != Changeset.ADD:
-                        old_node = self.get_node(path, old_rev, old_historian)
+                        old_node = GitNode.from_diff(self, path, old_rev, self.log,
+                                                     mode1, obj1, old_historian)
                     if change != Changeset.DELETE:
-                        new_node = self.get_node(path, new_rev, new_historian)
+                        new_node = GitNode.from_diff(self, path, new_rev, self.log,
+                                                     mode2, obj2, new_historian)
 
                     yield old_node, new_node, kind, change
 
     def next_rev(self, rev, path=''):
-        return self.git.hist_next_revision(rev)
+        return self.git.hist_next_revision(rev, path and path.strip('/'))
 
     def previous_rev(self, rev, path=''):
-        return self.git.hist_prev_revision(rev)
+        return self.git.hist_prev_revision(rev, path and path.strip('/'))
 
     def parent_revs(self, rev):
         return self.git.parents(rev)
@@ -466,11 +1472,22 @@ class GitRepository(Repository):
             return None # nothing expected to change
 
         if rev_callback:
+            self.git.get_rev_cache(fresh=True) # don't settle for a stale cache
             revs = set(self.git.all_revs()) - revs
             for rev in revs:
                 rev_callback(rev)
 
 class GitNode(Node):
+    """
+    Node within a git tree
+
+    `ls_tree_info` may be passed for a tree entry which is already
+    known (as returned by `Storage.ls_tree()`, possibly with unknown
+    size); otherwise the path is looked up in `rev`.  The revision
+    which last changed the node (i.e. `rev` and `created_rev`) is only
+    determined when accessed, using `historian` if still available.
+    """
+
     def __init__(self, repos, path, rev, log, ls_tree_info=None, historian=None):
         self.log = log
         self.repos = repos
@@ -479,6 +1496,11 @@ class GitNode(Node):
         self.fs_size = None
         rev = rev and str(rev) or 'HEAD'
 
+        self.__tree_rev = rev
+        self.__historian = historian
+        self.__rev = None
+        self.__rev_resolved = False
+
         kind = Node.DIRECTORY
         p = path.strip('/')
         if p: # ie. not the root-tree
@@ -492,8 +1514,8 @@ class GitNode(Node):
 
             self.fs_perm, k, self.fs_sha, self.fs_size, _ = ls_tree_info
 
-            # fix-up to the last commit-rev that touched this node
-            rev = repos.git.last_change(rev, p, historian)
+            # rev gets fixed-up to the last commit-rev that touched this node on access
+            rev = None
 
             if k == 'tree':
                 pass
@@ -505,10 +1527,36 @@ class GitNode(Node):
                 raise TracError("Internal error (got unexpected object kind '%s')" % k)
 
         self.created_path = path
-        self.created_rev = rev
 
         Node.__init__(self, repos, path, rev, kind)
 
+    @classmethod
+    def from_diff(cls, repos, path, rev, log, mode, sha, historian=None):
+        "create node from the mode and sha id of a `diff_tree()` record"
+
+        if mode.startswith('04'):
+            k = 'tree'
+        elif mode.startswith('16'):
+            k = 'commit'
+        else:
+            k = 'blob'
+
+        return cls(repos, path, rev, log, (mode, k, sha, None, path), historian)
+
+    def __get_rev(self):
+        if not self.__rev_resolved:
+            self.__rev = self.repos.git.last_change(self.__tree_rev, self.path.strip('/'),
+                                                    self.__historian)
+            self.__rev_resolved = True
+            self.__historian = None
+        return self.__rev
+
+    def __set_rev(self, rev): # only used by Node.__init__()
+        self.__rev = rev
+        self.__rev_resolved = rev is not None
+
+    rev = created_rev = property(__get_rev, __set_rev)
+
     def __git_path(self):
         "return path as expected by PyGIT"
         p = self.path.strip('/')
@@ -547,7 +1595,14 @@ class GitNode(Node):
         if self.isdir:
             return None
 
-        return ''
+        if not self.isfile:
+            return ''
+
+        # by file name, falling back to sniffing the (cached) beginning of the blob
+        mime_map = self.repos.mime_map
+        return get_mimetype(self.name, mime_map=mime_map) or \
+            get_mimetype(self.name, self.repos.git.get_file_prefix(self.fs_sha, self.fs_size),
+                         mime_map) or ''
 
     def get_content_length(self):
         if not self.isfile:
@@ -568,8 +1623,7 @@ class GitNode(Node):
             return None
 
         try:
-            msg, props = self.repos.git.read_commit(self.rev)
-            user, ts = _parse_user_time(props['committer'][0])
+            ts = self.repos.git.get_commit(self.rev).committer_time
         except:
             self.log.error("internal error (could not get timestamp from commit '%s')" % self.rev)
             return None
@@ -598,49 +1652,32 @@ class GitChangeset(Changeset):
             raise NoSuchChangeset(sha)
         
         try:
-            msg, props = repos.git.read_commit(sha)
+            commit = repos.git.get_commit(sha)
         except PyGIT.GitErrorSha:
             raise NoSuchChangeset(sha)
 
-        self.props = props
+        self.commit = commit
+        self.children = repos.git.children(sha)
 
-        assert 'children' not in props
-        _children = list(repos.git.children(sha))
-        if _children:
-            props['children'] = _children
+        user_, time_ = repos.get_commit_owner(commit)
 
-        # use 1st author/committer as changeset owner/timestamp
-        if repos._use_committer_time:
-            _, time_ = _parse_user_time(props['committer'][0])
-        else:
-            _, time_ = _parse_user_time(props['author'][0])
-
-        if repos._use_committer_id:
-            user_, _ = _parse_user_time(props['committer'][0])
-        else:
-            user_, _ = _parse_user_time(props['author'][0])
-
-        # try to resolve email address to trac uid
-        user_ = repos.rlookup_uid(user_) or user_
-
-        Changeset.__init__(self, repos, rev=sha, message=msg, author=user_, date=time_)
+        Changeset.__init__(self, repos, rev=sha, message=commit.message, author=user_, date=time_)
 
     def get_properties(self):
         properties = {}
+        commit = self.commit
 
-        if 'parent' in self.props:
-            properties['Parents'] = self.props['parent']
+        if commit.parents:
+            properties['Parents'] = list(commit.parents)
 
-        if 'children' in self.props:
-            properties['Children'] = self.props['children']
+        if self.children:
+            properties['Children'] = self.children
 
-        if 'committer' in self.props:
-            properties['git-committer'] = \
-                    _parse_user_time(self.props['committer'][0])
+        if commit.committer is not None:
+            properties['git-committer'] = (commit.committer, commit.committer_time)
 
-        if 'author' in self.props:
-            properties['git-author'] = \
-                    _parse_user_time(self.props['author'][0])
+        if commit.author is not None:
+            properties['git-author'] = (commit.author, commit.author_time)
 
         branches = list(self.repos.git.get_branch_contains(self.rev, resolve=True))
         if branches:
@@ -649,38 +1686,63 @@ class GitChangeset(Changeset):
         return properties
 
     def get_changes(self):
-        paths_seen = set()
-        for parent in self.props.get('parent', [None]):
-            for mode1, mode2, obj1, obj2, action, path1, path2 in \
-                    self.repos.git.diff_tree(parent, self.rev, find_renames=True):
-                path = path2 or path1
-                p_path, p_rev = path1, parent
+        return _get_changes(self.repos.git.get_commit_changes(self.rev))
 
-                kind = Node.FILE
-                if mode2.startswith('04') or mode1.startswith('04'):
-                    kind = Node.DIRECTORY
 
-                action = GitChangeset.action_map[action[0]]
+    def get_branches(self):
+        _rev = self.rev
 
-                if action == Changeset.ADD:
-                    p_path = ''
-                    p_rev = None
+        return [ (k, v == _rev)
+                 for k, v in self.repos.git.get_branch_contains(_rev, resolve=True) ]
 
-                # CachedRepository expects unique (rev, path, change_type) key
-                # this is only an issue in case of merges where files required editing
-                if path in paths_seen:
-                    continue
+class GitwebRepositoryInfo(dict):
+    """
+    Repository info for gitweb projects
 
-                paths_seen.add(path)
+    The project's `description` file is only re-read when its mtime
+    changed; in `lazy` mode, it's only looked at when the description
+    is actually accessed.
+    """
 
-                yield path, kind, action, p_path, p_rev
+    def __init__(self, description_path, lazy, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._description_path = description_path
+        self._description_mtime = None
+        self.lazy = lazy
 
+    def update_description(self):
+        try:
+            mtime = os.stat(self._description_path).st_mtime
+        except OSError:
+            mtime = None
 
-    def get_branches(self):
-        _rev = self.rev
+        if mtime == self._description_mtime:
+            return
+
+        if mtime is None:
+            dict.pop(self, 'description', None)
+        else:
+            dict.__setitem__(self, 'description',
+                             open(self._description_path).read().strip())
+        self._description_mtime = mtime
+
+    def __getitem__(self, key):
+        if key == 'description' and self.lazy:
+            self.update_description()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == 'description' and self.lazy:
+            self.update_description()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if key == 'description' and self.lazy:
+            self.update_description()
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
 
-        return [ (k, v == _rev)
-                 for k, v in self.repos.git.get_branch_contains(_rev, resolve=True) ]
 
 class GitwebProjectsRepositoryProvider(Component):
     implements(IRepositoryProvider)
@@ -688,23 +1750,50 @@ class GitwebProjectsRepositoryProvider(Component):
     projects_list = PathOption('git', 'projects_list', doc='Path to a gitweb-formatted projects.list')
     projects_base = PathOption('git', 'projects_base', doc='Path to the base of your git projects')
     projects_url = Option('git', 'projects_url', doc='Template for project URLs. %s will be replaced with the repo name')
+    projects_lazy_threshold = IntOption('git', 'projects_lazy_threshold', 1000,
+                                        "number of projects above which `description` files"
+                                        " are only checked for changes when accessed")
+
+    def __init__(self):
+        self._cache_key = None
+        self._repositories = []
+        self._lock = Lock()
 
     def get_repositories(self):
         if not self.projects_list:
             return
 
-        for line in open(self.projects_list):
-            line = line.strip()
+        # the parsed projects list is reused until it's modified
+        cache_key = (self.projects_list, self.projects_base, self.projects_url,
+                     self.projects_lazy_threshold, os.stat(self.projects_list).st_mtime)
+
+        with self._lock:
+            if cache_key != self._cache_key:
+                self._repositories = self._read_projects_list()
+                self._cache_key = cache_key
+            repositories = self._repositories
+
+        for name, repo in repositories:
+            if not repo.lazy:
+                repo.update_description()
+            yield name, repo
+
+    def _read_projects_list(self):
+        lines = [ line.strip() for line in open(self.projects_list) ]
+        lazy = len(lines) > self.projects_lazy_threshold
+
+        result = []
+        for line in lines:
             name = line
             if name.endswith('.git'):
                 name = name[:-4]
-            repo = {
-                'dir': os.path.join(self.projects_base, line),
-                'type': 'git',
-            }
-            description_path = os.path.join(repo['dir'], 'description')
-            if os.path.exists(description_path):
-                repo['description'] = open(description_path).read().strip()
+            repo_dir = os.path.join(self.projects_base, line)
+            repo = GitwebRepositoryInfo(os.path.join(repo_dir, 'description'), lazy,
+                                        dir=repo_dir, type='git')
             if self.projects_url:
                 repo['url'] = self.projects_url % name
-            yield name, repo
+            result.append((name, repo))
+
+        self.log.debug("read %d projects from '%s'" % (len(result), self.projects_list))
+
+        return result
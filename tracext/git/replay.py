@@ -0,0 +1,191 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+"""
+Replays traces recorded by PyGIT.StorageTracer (see the `[git]
+trace_file` option) against a local clone of the traced repository and
+reports latency percentiles per Storage method
+
+usage: python -m tracext.git.replay [options] TRACE_FILE GIT_DIR
+"""
+
+from __future__ import with_statement
+
+import sys, time, logging
+from optparse import OptionParser
+from threading import Lock, Thread
+from types import GeneratorType
+from Queue import Queue
+
+import PyGIT
+
+def _unjson(value):
+    "turn ASCII-only unicode strings (shas, revs) back into bytestrings"
+
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if isinstance(value, list):
+        return [ _unjson(v) for v in value ]
+    if isinstance(value, dict):
+        return dict((str(k), _unjson(v)) for k, v in value.iteritems())
+    return value
+
+def read_trace(f, repo=None):
+    "yields the call records of trace file `f`, optionally only those of `repo`"
+
+    try:
+        import json
+    except ImportError: # Python 2.5
+        import simplejson as json
+
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        rec = json.loads(line)
+        if repo is None or rec['repo'] == repo:
+            yield _unjson(rec)
+
+def replay_call(storage, rec):
+    "performs the call described by `rec`, consuming returned generators"
+
+    method, args, kw = rec['method'], rec['args'], rec['kw']
+
+    if method == 'get_historian':
+        with storage.get_historian(*args) as historian:
+            for path in kw['paths']:
+                historian(path)
+        return
+
+    result = getattr(storage, method)(*args, **kw)
+    if isinstance(result, GeneratorType):
+        for _ in result:
+            pass
+    elif hasattr(result, 'read'): # get_file()
+        result.read()
+
+def percentile(samples, p):
+    "returns the `p`th percentile of the sorted list `samples`"
+
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+def replay(storage, records, threads=1):
+    """
+    replays `records` against `storage` using `threads` concurrent
+    threads, which pick up the records in trace order
+
+    returns dict mapping method names to lists of (elapsed, error) tuples
+    """
+
+    queue = Queue()
+    for rec in records:
+        queue.put(rec)
+
+    results = {}
+    lock = Lock()
+
+    def worker():
+        while True:
+            rec = queue.get()
+            if rec is None:
+                break
+
+            error = None
+            ts0 = time.time()
+            try:
+                replay_call(storage, rec)
+            except Exception, e:
+                error = e.__class__.__name__
+            elapsed = time.time() - ts0
+
+            with lock:
+                results.setdefault(rec['method'], []).append((elapsed, error))
+
+    for _ in range(threads):
+        queue.put(None)
+
+    workers = [ Thread(target=worker) for _ in range(threads) ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    return results
+
+def format_report(results, recorded=None):
+    """
+    renders per-method latency percentiles (in ms) of the `replay()`
+    results, along with the median of the `recorded` timings
+    """
+
+    recorded = recorded or {}
+    lines = ["%-22s %7s %6s %9s %9s %9s %9s %9s"
+             % ("method", "calls", "errors", "p50", "p90", "p99", "max", "rec-p50")]
+
+    def line(name, samples, rec_samples):
+        times = sorted(e for e, _ in samples)
+        errors = len([ err for _, err in samples if err ])
+        return ("%-22s %7d %6d" % (name, len(times), errors)) + \
+            "".join(" %9.2f" % (1000 * v) for v in
+                    (percentile(times, 50), percentile(times, 90),
+                     percentile(times, 99), percentile(times, 100),
+                     percentile(sorted(rec_samples), 50)))
+
+    for name, samples in sorted(results.iteritems()):
+        lines.append(line(name, samples, recorded.get(name, [])))
+
+    lines.append(line("(all)", sum(results.values(), []), sum(recorded.values(), [])))
+
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] TRACE_FILE GIT_DIR")
+    parser.add_option('-t', '--threads', type='int', default=1,
+                      help="number of concurrent threads (default: 1)")
+    parser.add_option('-r', '--repo', default=None,
+                      help="only replay calls recorded for this git dir")
+    parser.add_option('-e', '--encoding', default='utf-8',
+                      help="git_fs_encoding of the traced repository (default: utf-8)")
+    parser.add_option('--git-bin', default='git',
+                      help="path to git executable (default: git)")
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 2:
+        parser.error("expected TRACE_FILE and GIT_DIR")
+
+    trace_file, git_dir = args
+
+    f = open(trace_file)
+    try:
+        records = list(read_trace(f, options.repo))
+    finally:
+        f.close()
+
+    recorded = {}
+    for rec in records:
+        recorded.setdefault(rec['method'], []).append(rec['elapsed'])
+
+    logging.basicConfig()
+    storage = PyGIT.Storage(git_dir, logging.getLogger('replay'),
+                            git_bin=options.git_bin,
+                            git_fs_encoding=options.encoding or None)
+
+    ts0 = time.time()
+    results = replay(storage, records, max(1, options.threads))
+    elapsed = time.time() - ts0
+
+    print format_report(results, recorded)
+    print
+    print "replayed %d calls with %d thread(s) in %.2f s" % (len(records), options.threads, elapsed)
+    print PyGIT.GitCommandStats.format_stats(PyGIT.command_stats.get_stats())
+
+if __name__ == '__main__':
+    main()
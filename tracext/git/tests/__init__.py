@@ -0,0 +1,21 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+import unittest
+
+def suite():
+    from tracext.git.tests import archive, replay, search, storage, wiki
+
+    suite = unittest.TestSuite()
+    suite.addTest(storage.suite())
+    suite.addTest(archive.suite())
+    suite.addTest(replay.suite())
+    suite.addTest(search.suite())
+    suite.addTest(wiki.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
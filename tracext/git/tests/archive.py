@@ -0,0 +1,85 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from StringIO import StringIO
+
+from trac.test import EnvironmentStub, MockPerm
+from trac.web.api import Request, RequestDone
+
+from tracext.git.git_fs import GitArchiveModule
+from tracext.git.tests.util import GitRepo
+
+
+class GitArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'tracext.git.*'])
+        self.env.path = tempfile.mkdtemp(prefix='tracgit-env-')
+        self.env.config.set('trac', 'repository_type', 'git')
+        self.env.config.set('trac', 'repository_dir', '')
+        self.env.config.set('browser', 'downloadable_paths', '/*')
+        self.repo = GitRepo()
+        self.env.config.set('repositories', 'proj.dir', self.repo.git_dir)
+        self.env.config.set('repositories', 'proj.type', 'git')
+        self.rev = self.repo.commit({'README': 'hello\n', 'src/main.c': 'int main;\n'},
+                                    'initial import')
+        self.archive = GitArchiveModule(self.env)
+
+    def tearDown(self):
+        self.repo.destroy()
+        shutil.rmtree(self.env.path)
+
+    def _request(self, path, method='GET', **args):
+        response = {}
+        out = StringIO()
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = dict(headers)
+            return out.write
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'SCRIPT_NAME': '',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http', 'wsgi.input': StringIO('')}
+        req = Request(environ, start_response)
+        req.perm = MockPerm()
+        req.args.update(args)
+        self.assertTrue(self.archive.match_request(req))
+        self.assertRaises(RequestDone, self.archive.process_request, req)
+        return response, out.getvalue()
+
+    def test_zip(self):
+        response, body = self._request('/git-archive/proj/src', rev=self.rev, format='zip')
+        self.assertEqual('200 Ok', response['status'])
+        self.assertEqual('application/zip', response['headers']['Content-Type'])
+        self.assertEqual(str(len(body)), response['headers']['Content-Length'])
+        archive = zipfile.ZipFile(StringIO(body))
+        name = 'proj-src-%s' % self.rev[:7]
+        self.assertEqual('int main;\n', archive.read('%s/main.c' % name))
+
+    def test_tar_gz(self):
+        response, body = self._request('/git-archive/proj', format='tar.gz')
+        self.assertEqual(str(len(body)), response['headers']['Content-Length'])
+        archive = tarfile.open(fileobj=StringIO(body), mode='r:gz')
+        name = 'proj-%s' % self.rev[:7]
+        self.assertEqual('hello\n', archive.extractfile('%s/README' % name).read())
+
+    def test_head(self):
+        response, body = self._request('/git-archive/proj', method='HEAD')
+        self.assertTrue(int(response['headers']['Content-Length']) > 0)
+        self.assertEqual('', body)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(GitArchiveTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,86 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+from __future__ import with_statement
+
+import os
+import unittest
+
+from tracext.git import PyGIT, replay
+from tracext.git.tests.util import GitRepo, log
+
+
+class FormatReportTestCase(unittest.TestCase):
+
+    def test_no_records(self):
+        report = replay.format_report({})
+        self.assertTrue('(all)' in report)
+
+    def test_percentiles(self):
+        results = {'get_commit': [(0.001, None), (0.003, None), (0.002, 'GitError')]}
+        lines = replay.format_report(results, {'get_commit': [0.002]}).splitlines()
+        fields = lines[1].split()
+        self.assertEqual(['get_commit', '3', '1'], fields[:3])
+        self.assertEqual('3.00', fields[6]) # max
+
+
+class TraceReplayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = GitRepo()
+        self.revs = [self.repo.commit({'a.txt': 'a1\n'}, 'add a'),
+                     self.repo.commit({'b.txt': 'b1\n'}, 'add b'),
+                     self.repo.commit({'a.txt': 'a2\n'}, 'change a')]
+        self.trace_file = os.path.join(self.repo.path, 'trace.json')
+
+    def tearDown(self):
+        self.repo.destroy()
+
+    def _read_trace(self):
+        f = open(self.trace_file)
+        try:
+            return list(replay.read_trace(f))
+        finally:
+            f.close()
+
+    def test_record_and_replay(self):
+        tracer = PyGIT.StorageTracer(self.trace_file)
+        storage = PyGIT.Storage(self.repo.git_dir, log, tracer=tracer)
+
+        c1, c2, c3 = self.revs
+        storage.get_commit(c3[:7]) # resolves the short rev and reads the commit
+        self.assertEqual([c1, c2], [ c.sha for c, _ in storage.log_changes(iter([c1, c2])) ])
+        storage.get_file_prefix(storage.ls_tree(c3, 'a.txt')[0][2])
+        storage.has_rev('ffcc00')
+        self.assertEqual(c1, storage.hist_prev_revision(c3, 'a.txt'))
+        with storage.get_historian(c3, '') as historian:
+            historian('a.txt')
+
+        records = self._read_trace()
+
+        # nested calls (e.g. fullrev() and cat_file() of get_commit()) aren't recorded
+        self.assertEqual(['get_commit', 'log_changes', 'ls_tree', 'get_file_prefix', 'has_rev',
+                          'hist_prev_revision', 'get_historian'],
+                         [ rec['method'] for rec in records ])
+        self.assertEqual([[c1, c2]], records[1]['args']) # consumed iterator recorded as list
+        self.assertEqual(['a.txt'], records[-1]['kw']['paths'])
+        self.assertEqual([None] * len(records), [ rec['error'] for rec in records ])
+
+        other = PyGIT.Storage(self.repo.git_dir, log)
+        results = replay.replay(other, records, threads=2)
+        self.assertEqual(sorted(set(rec['method'] for rec in records)), sorted(results))
+        for method, samples in results.iteritems():
+            self.assertEqual([None] * len(samples), [ error for _, error in samples ], method)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(FormatReportTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(TraceReplayTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
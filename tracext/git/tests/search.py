@@ -0,0 +1,124 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+import shutil
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.web.href import Href
+
+from tracext.git import PyGIT
+from tracext.git.git_fs import GitRepository, GitSearchModule
+from tracext.git.tests.util import GitRepo, log
+
+
+class GitSearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'tracext.git.*'])
+        self.env.path = tempfile.mkdtemp(prefix='tracgit-env-')
+        self.repo = GitRepo()
+        self.revs = [self.repo.commit({'a.txt': 'a1\n'}, 'add apples'),
+                     self.repo.commit({'b.txt': 'b1\n'}, 'add bananas', author='Ann <ann@example.org>')]
+        self.search = GitSearchModule(self.env)
+
+    def tearDown(self):
+        self.repo.destroy()
+        shutil.rmtree(self.env.path)
+
+    def _repos(self, path=None):
+        return GitRepository(path or self.repo.git_dir, {'name': '', 'id': 1}, log)
+
+    def _search(self, index, *words):
+        return [ rev for rev, _, _, _ in index.search(words) ]
+
+    def test_search(self):
+        c1, c2 = self.revs
+        index = self.search.update_index(self._repos())
+        self.assertEqual([c2], self._search(index, 'banana'))
+        self.assertEqual([c2], self._search(index, 'ann'))
+        self.assertEqual([c2, c1], self._search(index, 'add'))
+        self.assertEqual([c1], self._search(index, 'add', c1[:7]))
+        self.assertEqual([], self._search(index, 'cherries'))
+
+    def test_incremental_update(self):
+        c1, c2 = self.revs
+        index = self.search.update_index(self._repos())
+        self.assertEqual(set(self.revs), index.get_indexed(self.revs))
+
+        c3 = self.repo.commit({'c.txt': 'c\n'}, 'add cherries')
+        PyGIT.command_stats.reset()
+        self.search.update_index(self._repos())
+        self.assertEqual([c3], self._search(index, 'cherries'))
+        self.assertTrue('log' in PyGIT.command_stats.get_stats())
+
+        # nothing happened since: the refs are compared, and no commit is read
+        PyGIT.command_stats.reset()
+        self.search.update_index(self._repos())
+        self.assertFalse('log' in PyGIT.command_stats.get_stats())
+        self.assertFalse('rev-list' in PyGIT.command_stats.get_stats())
+
+    def test_limit(self):
+        c1, c2 = self.revs
+        index = self.search.update_index(self._repos(), limit=1)
+        self.assertEqual(set([c2]), index.get_indexed(self.revs)) # newest first
+        self.assertEqual(None, index.get_meta('heads')) # incomplete
+
+        self.search.update_index(self._repos(), limit=1)
+        self.assertEqual(set(self.revs), index.get_indexed(self.revs))
+        self.assertEqual(c2, index.get_meta('heads'))
+
+    def test_rewritten_history(self):
+        c1, c2 = self.revs
+        index = self.search.update_index(self._repos())
+
+        # the old head is gone for good
+        self.repo.git('reset', '-q', '--hard', c1)
+        self.repo.git('reflog', 'expire', '--expire=now', '--all')
+        self.repo.git('gc', '-q', '--prune=now')
+        c3 = self.repo.commit({'c.txt': 'c\n'}, 'add cherries')
+        self.search.update_index(self._repos())
+        self.assertEqual([c3], self._search(index, 'cherries'))
+
+    def test_user_terms(self):
+        c1, c2 = self.revs
+        self.env.config.set('trac', 'repository_dir', '')
+        self.env.config.set('repositories', '.dir', self.repo.git_dir)
+        self.env.config.set('repositories', '.type', 'git')
+        self.env.known_users = [('ann', 'Ann', 'ann@example.org')]
+        req = Mock(href=Href('/trac'), perm=MockPerm())
+
+        def search(*terms):
+            return [ href for href, _, _, _, _ in
+                     self.search.get_search_results(req, terms, ['changeset']) ]
+
+        self.assertEqual(['/trac/changeset/%s' % c2], search('author:ann'))
+        self.assertEqual(['/trac/changeset/%s' % c2], search('author:Ann@example.org', 'add'))
+        self.assertEqual(['/trac/changeset/%s' % c1], search('author:joe@example.org'))
+        self.assertEqual([], search('author:ann', 'apples'))
+        self.assertEqual(['/trac/changeset/%s' % c2, '/trac/changeset/%s' % c1],
+                         search('committer:joe@example.org'))
+
+    def test_moved_repository(self):
+        index = self.search.update_index(self._repos())
+        other = GitRepo()
+        try:
+            c = other.commit({'d.txt': 'd\n'}, 'add dates')
+            self.search.update_index(self._repos(other.git_dir))
+            self.assertEqual([c], self._search(index, 'add'))
+            self.assertEqual(other.git_dir, index.get_meta('repos'))
+        finally:
+            other.destroy()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(GitSearchTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
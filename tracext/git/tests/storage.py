@@ -0,0 +1,180 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+import random
+import time
+import unittest
+from threading import Thread
+
+from tracext.git import PyGIT
+from tracext.git.tests.util import GitRepo, log
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = GitRepo()
+        self.revs = [self.repo.commit({'a.txt': 'a1\n'}, 'add a'),
+                     self.repo.commit({'b.txt': 'b1\n'}, 'add b'),
+                     self.repo.commit({'a.txt': 'a2\n'}, 'change a'),
+                     self.repo.commit({'b.txt': 'b2\n'}, 'change b')]
+
+    def tearDown(self):
+        self.repo.destroy()
+
+    def _storage(self, **kw):
+        return PyGIT.Storage(self.repo.git_dir, log, **kw)
+
+    def test_command_stats(self):
+        PyGIT.command_stats.reset()
+        self._storage().youngest_rev()
+        stats = PyGIT.command_stats.get_stats()
+        self.assertTrue('rev-list' in stats)
+        self.assertEqual(0, stats['rev-list'].errors)
+
+    def test_path_relative_rev(self):
+        c1, c2, c3, c4 = self.revs
+        storage = self._storage()
+        self.assertEqual(c3, storage.hist_next_revision(c1, 'a.txt'))
+        self.assertEqual(None, storage.hist_next_revision(c3, 'a.txt'))
+        self.assertEqual(c1, storage.hist_prev_revision(c3, 'a.txt'))
+        self.assertEqual(c1, storage.hist_prev_revision(c2, 'a.txt')) # c2 doesn't touch a.txt
+        self.assertEqual(c4, storage.hist_next_revision(c2, 'b.txt'))
+        self.assertEqual(c2, storage.hist_next_revision(c1)) # not path-restricted
+
+    def test_sync_invalidates_rev_cache(self):
+        storage = self._storage()
+        self.assertEqual(self.revs[-1], storage.youngest_rev())
+        self.assertFalse(storage.sync())
+
+        new = self.repo.commit({'c.txt': 'c\n'}, 'add c')
+        self.assertTrue(storage.sync())
+        self.assertEqual(new, storage.youngest_rev())
+        self.assertEqual(new, storage.verifyrev(new[:7]))
+
+    def test_stale_rev_cache_is_served_and_refreshed(self):
+        storage = self._storage(rev_cache_max_staleness=60)
+        old = storage.get_rev_cache()
+        new = self.repo.commit({'c.txt': 'c\n'}, 'add c')
+        self.assertTrue(storage.sync())
+
+        # readers get the stale snapshot, or the rebuilt one, but never wait
+        self.assertTrue(storage.get_rev_cache().youngest_rev in (old.youngest_rev, new))
+
+        deadline = time.time() + 10
+        while storage.get_rev_cache().youngest_rev != new and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(new, storage.get_rev_cache().youngest_rev)
+
+    def test_fresh_rev_cache_waits_for_rebuild(self):
+        storage = self._storage(rev_cache_max_staleness=60)
+        storage.get_rev_cache()
+        new = self.repo.commit({'c.txt': 'c\n'}, 'add c')
+        storage.sync()
+        self.assertEqual(new, storage.get_rev_cache(fresh=True).youngest_rev)
+
+    def test_user_commits(self):
+        c1, c2, c3, c4 = self.revs
+        c5 = self.repo.commit({'c.txt': 'c\n'}, 'add c', author='Ann <Ann@example.org>')
+        storage = self._storage()
+        self.assertEqual([c1, c2, c3, c4], storage.get_user_commits('joe@example.org'))
+        self.assertEqual([c5], storage.get_user_commits('Ann Other <ann@EXAMPLE.org>'))
+        self.assertEqual([c1, c2, c3, c4, c5],
+                         storage.get_user_commits('joe@example.org', role='committer'))
+        self.assertEqual([c2, c3], storage.get_user_commits('joe@example.org',
+                                                            1300000002, 1300000003))
+        self.assertEqual([], storage.get_user_commits('nobody@example.org'))
+
+    def test_user_index_is_updated_incrementally(self):
+        c1, c2, c3, c4 = self.revs
+        storage = self._storage()
+        old = storage.get_rev_cache()
+
+        c5 = self.repo.commit({'c.txt': 'c\n'}, 'add c', author='Ann <ann@example.org>')
+        storage.sync()
+        new = storage.get_rev_cache()
+        self.assertEqual([c5], storage.get_user_commits('ann@example.org'))
+        # the untouched author's entry is taken over as is
+        self.assertTrue(old.author_index['joe@example.org'] is new.author_index['joe@example.org'])
+        self.assertEqual([c1, c2, c3, c4, c5],
+                         storage.get_user_commits('joe@example.org', role='committer'))
+
+        # rewritten history: the indices are rebuilt
+        self.repo.git('reset', '-q', '--hard', c3)
+        c6 = self.repo.commit({'d.txt': 'd\n'}, 'add d')
+        storage.sync()
+        self.assertEqual([c1, c2, c3, c6], storage.get_user_commits('joe@example.org'))
+        self.assertEqual([], storage.get_user_commits('ann@example.org'))
+
+    def test_idle_pipe_is_closed(self):
+        storage = PyGIT.StorageFactory(self.repo.git_dir, log, idle_pipe_timeout=1).getInstance()
+        storage.get_commit(self.revs[0]) # starts the cat-file pipe
+        p = storage._Storage__cat_file_pipe
+        self.assertEqual(None, p.poll())
+
+        # no further instances are requested in the meantime
+        deadline = time.time() + 10
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertNotEqual(None, p.poll())
+        self.assertEqual(None, storage._Storage__cat_file_pipe)
+
+
+class LRUDictTestCase(unittest.TestCase):
+
+    def test_eviction_order(self):
+        d = PyGIT.LRUDict(3)
+        d['a'], d['b'], d['c'] = 1, 2, 3
+        self.assertEqual(1, d['a']) # reading counts as use
+        d['d'] = 4
+        self.assertEqual(['a', 'c', 'd'], sorted(d))
+        d['c'] = 5 # so does writing
+        d['e'] = 6
+        self.assertEqual(['c', 'd', 'e'], sorted(d))
+        self.assertEqual(None, d.get('a'))
+
+    def test_threads(self):
+        d = PyGIT.LRUDict(50)
+        errors = []
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            try:
+                for _ in xrange(5000):
+                    key = rnd.randrange(200)
+                    if rnd.random() < 0.5:
+                        d[key] = key
+                    else:
+                        self.assertTrue(d.get(key) in (None, key))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [ Thread(target=worker, args=(seed,)) for seed in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(50, len(d))
+
+        # the recency list survived intact: the least recently used entry goes first
+        keys = list(d)
+        for key in keys[1:]:
+            d[key]
+        d['new'] = None
+        self.assertFalse(keys[0] in d)
+        self.assertEqual(50, len(d))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(StorageTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LRUDictTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,74 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+"""
+Helpers for building scratch git repositories in tests
+"""
+
+import os, shutil, tempfile, logging
+from subprocess import Popen, PIPE
+
+log = logging.getLogger('tracext.git.tests')
+log.setLevel(logging.CRITICAL)
+
+class GitRepo(object):
+    """
+    Non-bare git repository in a temporary folder; `git_dir` is what
+    PyGIT.Storage is to be pointed at
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='tracgit-test-')
+        self.git_dir = os.path.join(self.path, '.git')
+        self.time = 1300000000
+        self.git('init', '-q')
+
+    def destroy(self):
+        shutil.rmtree(self.path)
+
+    def git(self, *args, **kw):
+        "runs git command in the working tree and returns its stripped stdout"
+
+        env = dict(os.environ)
+        env.update(GIT_AUTHOR_NAME='Joe', GIT_AUTHOR_EMAIL='joe@example.org',
+                   GIT_COMMITTER_NAME='Joe', GIT_COMMITTER_EMAIL='joe@example.org',
+                   GIT_AUTHOR_DATE='%d +0000' % self.time,
+                   GIT_COMMITTER_DATE='%d +0000' % self.time)
+        env.update(kw.get('env', {}))
+        p = Popen(('git',) + args, cwd=self.path, env=env, stdout=PIPE, stderr=PIPE)
+        out, err = p.communicate()
+        if p.returncode:
+            raise RuntimeError("git %s failed: %s" % (' '.join(args), err))
+        return out.strip()
+
+    def commit(self, files, message, author=None):
+        """
+        writes `files` (dict mapping paths to contents, or to None for
+        deleting them), commits them one second after the previous
+        commit and returns the new commit's sha
+        """
+
+        for path, content in files.iteritems():
+            fname = os.path.join(self.path, path)
+            if content is None:
+                os.unlink(fname)
+                continue
+            if not os.path.isdir(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            f = open(fname, 'wb')
+            try:
+                f.write(content)
+            finally:
+                f.close()
+
+        self.time += 1
+        env = {}
+        if author:
+            name, email = author.split(' <')
+            env = dict(GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=email.rstrip('>'))
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', message, env=env)
+        return self.git('rev-parse', 'HEAD')
@@ -0,0 +1,84 @@
+# -*- coding: iso-8859-1 -*-
+#
+# Copyright (C) 2006-2011, Herbert Valerio Riedel <hvr@gnu.org>
+#
+# See COPYING for distribution information
+
+import shutil
+import tempfile
+import unittest
+
+from trac.mimeview.api import Context
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.web.href import Href
+from trac.wiki.formatter import format_to_oneliner
+
+from tracext.git import PyGIT
+from tracext.git.tests.util import GitRepo
+
+
+class ShaLinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'tracext.git.*'])
+        self.env.path = tempfile.mkdtemp(prefix='tracgit-env-')
+        self.env.config.set('trac', 'repository_dir', '')
+        self.env.config.set('git', 'persistent_cache', 'true')
+        self.env.config.set('git', 'wiki_shortrev_len', '7')
+        self.repo = GitRepo()
+        self.env.config.set('repositories', '.dir', self.repo.git_dir)
+        self.env.config.set('repositories', '.type', 'git')
+        self.rev = self.repo.commit({'a.txt': 'a\n'}, 'add a')
+
+        req = Mock(href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+                   authname='anonymous', perm=MockPerm(), chrome={}, session={},
+                   tz=None, locale=None, args={})
+        self.context = Context.from_request(req, 'wiki', 'WikiStart')
+
+        self.repos = self.env.get_repository('')
+        self.repos.git.get_rev_cache()
+
+    def tearDown(self):
+        self.repo.destroy()
+        shutil.rmtree(self.env.path)
+
+    def _render(self, text):
+        PyGIT.command_stats.reset()
+        html = unicode(format_to_oneliner(self.env, self.context, text))
+        return html, PyGIT.command_stats.get_stats()
+
+    def test_known_sha(self):
+        html, _ = self._render(self.rev[:7])
+        self.assertTrue('class="changeset"' in html)
+        self.assertTrue('/trac/changeset/%s' % self.rev in html)
+
+    def test_missing_sha(self):
+        for text in ('deadbee', 'ffeedd00', '0' * 40):
+            html, stats = self._render(text)
+            self.assertTrue('class="missing changeset"' in html, text)
+            self.assertEqual({}, stats, text)
+
+    def test_missing_sha_while_stale(self):
+        storage = self.repos.git
+        storage.get_rev_cache()
+        new = self.repo.commit({'b.txt': 'b\n'}, 'add b')
+        self.assertTrue(storage.sync())
+
+        # the outdated revision cache still tells old and bogus shas apart
+        self.assertEqual(True, storage.has_rev(self.rev))
+        self.assertEqual(True, storage.has_rev(self.rev[:7]))
+        self.assertEqual(False, storage.has_rev('deadbee'))
+        self.assertEqual(None, storage.has_rev(new)) # may have been pushed meanwhile
+
+        html, stats = self._render('deadbee')
+        self.assertTrue('class="missing changeset"' in html)
+        self.assertEqual({}, stats)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ShaLinkTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')